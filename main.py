@@ -1,19 +1,58 @@
 # This script creates Anki decks or CSV files from a CSV input file,
 # translating the sentences and generating audio using Azure Speech API.
+import io
 import os
+import re
+import sys
+import bz2
 import csv
+import glob
+import gzip
+import json
+import lzma
+import mmap
+import array
+import struct
+import locale
+import sqlite3
 import argparse
 import genanki
 import time
+import queue
 import random
+import string
+import asyncio
+import hashlib
+import wave
+import importlib
+import itertools
+import unicodedata
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from xml.sax.saxutils import escape, quoteattr
 from loguru import logger
 from dotenv import load_dotenv
-from functools import partial
 from googletrans import Translator
-from multiprocessing import Pool, cpu_count
-from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, AudioConfig, ResultReason, SpeechSynthesisCancellationDetails
+from multiprocessing import Array, Pool, cpu_count
+from azure.cognitiveservices.speech import SpeechConfig, SpeechSynthesizer, Connection, ResultReason, SpeechSynthesisCancellationDetails, SpeechSynthesisOutputFormat
 from slugify import slugify
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 # Load environment variables from the .env file
 load_dotenv()
 
@@ -28,39 +67,632 @@ anki_deck_id = int(os.getenv('ANKI_DECK_ID'))
 OUTPUT_DIR = os.getenv('OUTPUT_DIR')
 AUDIO_OUTPUT_DIR = f'{OUTPUT_DIR}/audio'
 
-# Reads data from a file and returns a list of dictionaries.
-def read_input_file(file_name):
-    logger.info('Reading input file.')
-    _, file_extension = os.path.splitext(file_name)
+# Maximum number of cards submitted to the audio stage but not yet consumed
+MAX_CARDS_IN_FLIGHT = int(os.getenv('MAX_CARDS_IN_FLIGHT', 1000))
+
+# Sentences are translated in batches of up to this many characters and sentences per request
+TRANSLATION_BATCH_CHARS = int(os.getenv('TRANSLATION_BATCH_CHARS', 4500))
+TRANSLATION_BATCH_SIZE = int(os.getenv('TRANSLATION_BATCH_SIZE', 100))
+
+# Number of translation requests the asyncio translation stage keeps in flight
+TRANSLATION_CONCURRENCY = int(os.getenv('TRANSLATION_CONCURRENCY', 200))
+
+# Requests and characters per second allowed by each backend across all processes (0: no limit)
+RATE_LIMITS = {
+    'translation': (float(os.getenv('TRANSLATION_REQUESTS_PER_SECOND', 0)), float(os.getenv('TRANSLATION_CHARS_PER_SECOND', 0))),
+    'speech': (float(os.getenv('SPEECH_REQUESTS_PER_SECOND', 0)), float(os.getenv('SPEECH_CHARS_PER_SECOND', 0))),
+}
+
+# Number of speech syntheses the audio stage keeps in flight
+SPEECH_CONCURRENCY = int(os.getenv('SPEECH_CONCURRENCY', 32))
+
+# Sentences of the same voice are synthesized together in SSML documents of up to this many characters
+# and split at bookmarks into their audio files (0: one request per sentence)
+SPEECH_BATCH_CHARS = int(os.getenv('SPEECH_BATCH_CHARS', 0))
+
+# Seconds the card pipeline waits for a batch of sentences to be sent before sending it itself
+SPEECH_BATCH_WAIT = 1.0
+
+# Retries of a failed translation request, with exponential backoff from the base delay up to the
+# maximum delay in seconds
+TRANSLATION_MAX_RETRIES = int(os.getenv('TRANSLATION_MAX_RETRIES', 5))
+TRANSLATION_RETRY_BASE_DELAY = float(os.getenv('TRANSLATION_RETRY_BASE_DELAY', 0.5))
+TRANSLATION_RETRY_MAX_DELAY = float(os.getenv('TRANSLATION_RETRY_MAX_DELAY', 30))
+
+# The translation stage pauses for the cooldown in seconds when at least this share of the last
+# window of translation requests failed
+TRANSLATION_BREAKER_WINDOW = int(os.getenv('TRANSLATION_BREAKER_WINDOW', 20))
+TRANSLATION_BREAKER_ERROR_RATE = float(os.getenv('TRANSLATION_BREAKER_ERROR_RATE', 0.5))
+TRANSLATION_BREAKER_COOLDOWN = float(os.getenv('TRANSLATION_BREAKER_COOLDOWN', 30))
+
+# Number of input files read concurrently, and how many sentences each reader hands over at once
+INPUT_READ_WORKERS = int(os.getenv('INPUT_READ_WORKERS', 4))
+INPUT_READ_CHUNK_SIZE = 1000
+
+# File extensions picked up when a directory is given as input
+INPUT_FILE_EXTENSIONS = ('.txt', '.csv', '.jsonl', '.ndjson', '.parquet', '.arrow', '.feather')
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+ARROW_EXTENSIONS = ('.arrow', '.feather')
+
+# Input path that reads sentences from stdin, and the formats it can be given in
+STDIN_FILE_NAME = '-'
+STDIN_INPUT_FORMATS = ('txt', 'csv', 'jsonl')
+
+# Output file name that writes CSV rows to stdout, and the name its side files (rejects, manifest) get instead
+STDOUT_FILE_NAME = '-'
+STDOUT_SIDE_FILE_NAME = 'stdout'
+
+# Line-offset indexes of TXT files are cached next to them, and are rebuilt when the file changes
+LINE_INDEX_SUFFIX = '.idx'
+LINE_INDEX_HEADER = struct.Struct('<8sQQ')
+LINE_INDEX_MAGIC = b'AECIDX1\x00'
+
+# Cards of earlier runs are kept in a manifest per input/output pair, committed every few cards
+MANIFEST_COMMIT_INTERVAL = 100
+
+# Translations are cached in an SQLite file shared by all workers; set it to an empty value to disable the cache
+TRANSLATION_CACHE_FILE = os.getenv('TRANSLATION_CACHE_FILE', f'{OUTPUT_DIR}/translations.sqlite3')
+
+# Rows of a TSV file loaded into the translation cache per transaction
+TRANSLATION_IMPORT_CHUNK_SIZE = 100000
+
+# Translation memory of near-duplicate sentences: 'off', 'flag' to list the matches above the
+# similarity threshold in the matches file for review, or 'reuse' to also use their translations
+TRANSLATION_MEMORY = os.getenv('TRANSLATION_MEMORY', 'off')
+TRANSLATION_MEMORY_THRESHOLD = float(os.getenv('TRANSLATION_MEMORY_THRESHOLD', 0.7))
+TRANSLATION_MEMORY_FILE = os.getenv('TRANSLATION_MEMORY_FILE', f'{OUTPUT_DIR}/translation_memory.sqlite3')
+TRANSLATION_MEMORY_MATCHES_FILE = os.getenv('TRANSLATION_MEMORY_MATCHES_FILE', f'{OUTPUT_DIR}/translation_memory_matches.tsv')
+TRANSLATION_MEMORY_MODES = ('off', 'flag', 'reuse')
+
+# MinHash signatures of the translation memory have this many values, split into LSH bands of
+# MINHASH_BAND_SIZE values; at most TRANSLATION_MEMORY_CANDIDATES entries are compared per lookup
+MINHASH_PERMUTATIONS = 64
+MINHASH_BAND_SIZE = 3
+MINHASH_PRIME = (1 << 61) - 1
+TRANSLATION_MEMORY_CANDIDATES = 50
+
+# Translation backend: a name from TRANSLATION_BACKENDS or a 'module:Class' import path
+TRANSLATION_BACKEND = os.getenv('TRANSLATION_BACKEND', 'google')
+
+# Lookup table (TSV of text and translation) and per-request latency in seconds of the offline backend
+OFFLINE_TRANSLATION_FILE = os.getenv('OFFLINE_TRANSLATION_FILE')
+OFFLINE_TRANSLATION_LATENCY = float(os.getenv('OFFLINE_TRANSLATION_LATENCY', 0))
+
+# Default CSV column, JSONL field or Parquet/Arrow column holding the sentences
+DEFAULT_SENTENCE_FIELD = 'sentence'
+
+# Number of rows read at once from Parquet files
+PARQUET_BATCH_SIZE = 65536
+
+# Compressed inputs are recognized by their magic bytes, or by their extension
+COMPRESSION_MAGIC_BYTES = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd'}
+
+# Detects the compression of a file, returning None for uncompressed files
+def detect_compression(file_name):
+    with open(file_name, 'rb') as f:
+        head = f.read(max(len(magic) for magic in COMPRESSION_MAGIC_BYTES))
+    for magic, compression in COMPRESSION_MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return compression
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+
+# Returns the lowercase extension of the data inside a file, ignoring any compression extension
+def input_file_extension(file_name):
+    name, file_extension = os.path.splitext(file_name)
+    if file_extension.lower() in COMPRESSION_EXTENSIONS:
+        _, file_extension = os.path.splitext(name)
+    return file_extension.lower()
+
+# Opens a file for reading as text, decompressing it on the fly if needed.
+# stdin is returned as is and left open when the returned file is closed.
+def open_input_file(file_name, newline=None):
+    if file_name == STDIN_FILE_NAME:
+        return contextlib.nullcontext(sys.stdin)
+
+    compression = detect_compression(file_name)
+    if compression == 'gzip':
+        return gzip.open(file_name, 'rt', newline=newline)
+    elif compression == 'bz2':
+        return bz2.open(file_name, 'rt', newline=newline)
+    elif compression == 'xz':
+        return lzma.open(file_name, 'rt', newline=newline)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError(f'Reading {file_name} requires the zstandard package.')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), closefd=True)
+        return io.TextIOWrapper(reader, newline=newline)
+    return open(file_name, 'r', newline=newline)
 
-    if file_extension.lower() == '.csv':
-        with open(file_name, 'r') as f:
+# Yields the non-empty strings of a column from Arrow record batches.
+# Blank and null values are filtered with vectorized compute kernels, one batch at a time.
+def iter_arrow_batches_sentences(batches, field):
+    for batch in batches:
+        column = batch.column(field)
+        if not pyarrow.types.is_string(column.type) and not pyarrow.types.is_large_string(column.type):
+            column = pyarrow.compute.cast(column, pyarrow.string())
+        not_blank = pyarrow.compute.not_equal(pyarrow.compute.utf8_trim_whitespace(column), '')
+        yield from pyarrow.compute.filter(column, not_blank, null_selection_behavior='drop').to_pylist()
+
+# Lazily yields the sentences of a Parquet file, reading only the sentence column
+def iter_parquet_file(file_name, field):
+    parquet_file = pyarrow.parquet.ParquetFile(file_name)
+    if field not in parquet_file.schema_arrow.names:
+        raise ValueError(f'Parquet file does not contain a "{field}" column.')
+    yield from iter_arrow_batches_sentences(
+        parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=[field]), field)
+
+# Lazily yields the sentences of an Arrow IPC (Feather v2) file, memory-mapping it so that
+# only the sentence column is paged in
+def iter_arrow_file(file_name, field):
+    with pyarrow.memory_map(file_name) as source:
+        try:
+            reader = pyarrow.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pyarrow.ArrowInvalid:
+            source.seek(0)
+            reader = pyarrow.ipc.open_stream(source)
+            batches = iter(reader)
+
+        if field not in reader.schema.names:
+            raise ValueError(f'Arrow file does not contain a "{field}" column.')
+        yield from iter_arrow_batches_sentences(batches, field)
+
+# Parses a "START:END" line range, where either side can be omitted
+def parse_line_range(value):
+    start, separator, end = value.partition(':')
+    if not separator:
+        raise ValueError(f'Invalid line range "{value}", expected START:END.')
+    start = int(start) if start else None
+    end = int(end) if end else None
+    if (start is not None and start < 0) or (end is not None and end < 0):
+        raise ValueError(f'Invalid line range "{value}", line numbers must not be negative.')
+    return start, end
+
+# Parses an "i/N" shard, where i is the 0-based shard number out of N shards
+def parse_shard(value):
+    index, separator, count = value.partition('/')
+    if not separator:
+        raise ValueError(f'Invalid shard "{value}", expected i/N.')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f'Invalid shard "{value}", i must be between 0 and N - 1.')
+    return index, count
+
+# Scans a memory-mapped file and returns the offset at which each line starts,
+# followed by the file size, so that line i spans offsets[i]:offsets[i + 1]
+def build_line_index(mapped_file):
+    offsets = array.array('Q', [0])
+    size = len(mapped_file)
+    position = mapped_file.find(b'\n')
+    while position != -1:
+        offsets.append(position + 1)
+        position = mapped_file.find(b'\n', position + 1)
+    if offsets[-1] != size:
+        offsets.append(size)
+    return offsets
+
+# Opens the cached line-offset index of a file, building and caching it if it is missing or outdated.
+# Returns the number of lines and a function that returns the offsets of lines start to end (the
+# offset after the last line included). Offsets are read from the cached index one slice at a time,
+# so readers of a slice of a large file do not load the offsets of all of its lines.
+def load_line_index(file_name, mapped_file):
+    index_file_name = file_name + LINE_INDEX_SUFFIX
+    stat = os.stat(file_name)
+    header = LINE_INDEX_HEADER.pack(LINE_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns)
+    offset_size = array.array('Q').itemsize
+
+    if os.path.exists(index_file_name):
+        with open(index_file_name, 'rb') as f:
+            if f.read(LINE_INDEX_HEADER.size) == header:
+                num_lines = (os.fstat(f.fileno()).st_size - LINE_INDEX_HEADER.size) // offset_size - 1
+
+                def read_offsets(start, end):
+                    offsets = array.array('Q')
+                    with open(index_file_name, 'rb') as index_file:
+                        index_file.seek(LINE_INDEX_HEADER.size + start * offset_size)
+                        offsets.frombytes(index_file.read((end - start + 1) * offset_size))
+                    return offsets
+                return num_lines, read_offsets
+
+    logger.info(f'Building line index for {file_name}.')
+    offsets = build_line_index(mapped_file)
+    try:
+        temp_file_name = f'{index_file_name}.{os.getpid()}.tmp'
+        with open(temp_file_name, 'wb') as f:
+            f.write(header)
+            f.write(offsets.tobytes())
+        os.replace(temp_file_name, index_file_name)
+    except OSError as e:
+        logger.warning(f'Could not cache the line index of {file_name}: {e}')
+    return len(offsets) - 1, lambda start, end: offsets[start:end + 1]
+
+# Lazily yields the non-empty lines of a slice of a TXT file. The file is memory-mapped and its
+# cached line index is used to jump to the first line, so only the selected lines are read.
+def iter_txt_file_lines(file_name, line_range=None, shard=None):
+    if os.path.getsize(file_name) == 0:
+        return
+
+    encoding = locale.getpreferredencoding(False)
+    with open(file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        num_lines, read_offsets = load_line_index(file_name, mapped_file)
+
+        start, end = line_range or (None, None)
+        start = min(num_lines, start if start is not None else 0)
+        end = max(start, min(num_lines, end if end is not None else num_lines))
+        if shard:
+            index, count = shard
+            start, end = start + (end - start) * index // count, start + (end - start) * (index + 1) // count
+
+        logger.info(f'Reading lines {start} to {end} of {num_lines} from {file_name}.')
+        offsets = read_offsets(start, end)
+        for i in range(end - start):
+            line = mapped_file[offsets[i]:offsets[i + 1]].decode(encoding).rstrip('\r\n')
+            if line.strip():
+                yield line
+
+# Reads a file and lazily yields its non-empty sentences, one at a time.
+# input_format overrides the format given by the file extension, and is how the format of stdin is chosen.
+# line_range and shard select a slice of the lines of an uncompressed TXT file.
+def iter_input_file(file_name, field=DEFAULT_SENTENCE_FIELD, input_format=None, line_range=None, shard=None):
+    logger.info(f'Reading input file {file_name}.')
+    if input_format:
+        file_extension = f'.{input_format}'
+    elif file_name == STDIN_FILE_NAME:
+        file_extension = '.txt'
+    else:
+        file_extension = input_file_extension(file_name)
+    if file_name == STDIN_FILE_NAME and file_extension[1:] not in STDIN_INPUT_FORMATS:
+        raise ValueError(f'stdin can only be read as {", ".join(STDIN_INPUT_FORMATS)}.')
+    if (line_range or shard) and (file_extension != '.txt' or file_name == STDIN_FILE_NAME or detect_compression(file_name)):
+        raise ValueError(f'Line ranges and shards are only supported for uncompressed TXT files, not {file_name}.')
+
+    if file_extension == '.csv':
+        with open_input_file(file_name, newline='') as f:
             reader = csv.DictReader(f)
             try:
-                csv_data = list(reader)
-                if 'sentence' in csv_data[0]:
-                    sentences = [d['sentence'] for d in csv_data if d['sentence'].strip()]
-                else:
-                    raise ValueError('CSV file does not contain a "sentence" column.')
+                if reader.fieldnames is None or field not in reader.fieldnames:
+                    raise ValueError(f'CSV file does not contain a "{field}" column.')
+                for row in reader:
+                    if row[field] and row[field].strip():
+                        yield row[field]
             except csv.Error as e:
                 raise ValueError('File is not a valid CSV.') from e
+    elif file_extension in JSONL_EXTENSIONS:
+        with open_input_file(file_name) as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f'Line {line_number} of {file_name} is not valid JSON.') from e
+                if not isinstance(record, dict):
+                    raise ValueError(f'Line {line_number} of {file_name} is not a JSON object.')
+                sentence = record.get(field)
+                if isinstance(sentence, str) and sentence.strip():
+                    yield sentence
+    elif file_extension == '.parquet' or file_extension in ARROW_EXTENSIONS:
+        if pyarrow is None:
+            raise ValueError(f'Reading {file_name} requires the pyarrow package.')
+        if detect_compression(file_name):
+            raise ValueError(f'{file_name} must not be compressed, Parquet and Arrow files are read in place.')
+        if file_extension == '.parquet':
+            yield from iter_parquet_file(file_name, field)
+        else:
+            yield from iter_arrow_file(file_name, field)
+    elif line_range or shard:
+        yield from iter_txt_file_lines(file_name, line_range, shard)
     else:
-        with open(file_name, 'r') as f:
-            sentences = [line for line in f.read().splitlines() if line.strip()]
+        with open_input_file(file_name) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.strip():
+                    yield line
+
+# Reads data from a file and returns a list of sentences.
+def read_input_file(file_name, field=DEFAULT_SENTENCE_FIELD, input_format=None, line_range=None, shard=None):
+    return list(iter_input_file(file_name, field, input_format, line_range, shard))
+
+# Expands input paths, glob patterns and directories into a sorted list of unique input files
+def expand_input_paths(paths):
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+                if input_file_extension(name) in INPUT_FILE_EXTENSIONS)
+        elif glob.has_magic(path):
+            matches = sorted(
+                match for match in glob.glob(path, recursive=True)
+                if os.path.isfile(match) and input_file_extension(match) in INPUT_FILE_EXTENSIONS)
+        else:
+            matches = [path]
+
+        if not matches:
+            raise ValueError(f'No input files match "{path}".')
+        file_names.extend(matches)
+
+    return list(dict.fromkeys(file_names))
+
+# Reads several files concurrently and yields (file_name, sentence) pairs as one stream, in file order.
+# Up to max_workers files are read ahead in background threads, each into its own bounded queue.
+# Sentences from stdin are handed over one by one, so they reach the pool as soon as they arrive.
+def iter_input_files(file_names, max_workers=INPUT_READ_WORKERS, field=DEFAULT_SENTENCE_FIELD, input_format=None,
+                     line_range=None, shard=None):
+    stop_event = threading.Event()
+    end_of_file = object()
+
+    def read(file_name, chunks):
+        chunk_size = 1 if file_name == STDIN_FILE_NAME else INPUT_READ_CHUNK_SIZE
+        try:
+            chunk = []
+            for sentence in iter_input_file(file_name, field, input_format, line_range, shard):
+                chunk.append(sentence)
+                if len(chunk) >= chunk_size:
+                    if not put_until_stopped(chunks, chunk, stop_event):
+                        return
+                    chunk = []
+            if chunk and not put_until_stopped(chunks, chunk, stop_event):
+                return
+        except Exception as e:
+            put_until_stopped(chunks, e, stop_event)
+        else:
+            put_until_stopped(chunks, end_of_file, stop_event)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        file_names = iter(file_names)
+        readers = deque()
 
+        def start_next_reader():
+            file_name = next(file_names, None)
+            if file_name is not None:
+                chunks = queue.Queue(maxsize=max_workers)
+                executor.submit(read, file_name, chunks)
+                readers.append((file_name, chunks))
+
+        for _ in range(max_workers):
+            start_next_reader()
+
+        try:
+            while readers:
+                file_name, chunks = readers.popleft()
+                while True:
+                    chunk = chunks.get()
+                    if chunk is end_of_file:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    for sentence in chunk:
+                        yield file_name, sentence
+                start_next_reader()
+        finally:
+            stop_event.set()
+
+# Abbreviations that end with a period without ending a sentence, in lowercase and without the final period
+SENTENCE_ABBREVIATIONS = frozenset({
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'rev', 'lt', 'sgt', 'capt', 'gov', 'vs', 'approx',
+    'dept', 'inc', 'ltd', 'corp',
+})
+
+# Numbering abbreviations and months, which are also everyday words ("I said no."), so they only
+# keep a sentence going when a number follows, as in "No. 5" or "Jan. 1"
+NUMBERING_ABBREVIATIONS = frozenset({
+    'no', 'nos', 'vol', 'p', 'pp', 'fig', 'figs', 'sec', 'ch',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+})
+
+# Candidate sentence ends: terminal punctuation, optionally followed by closing quotes or brackets, then whitespace
+SENTENCE_END = re.compile(r'[.!?…]+["\'”’»)\]]*(?=\s+(["\'“‘«(\[]*)(\S))')
+
+# Number of paragraphs segmented together by each worker
+SEGMENT_CHUNK_SIZE = 1000
+
+# Splits a paragraph into sentences with rule-based boundaries. Periods after abbreviations, initials
+# and numbering abbreviations followed by a number do not end a sentence, numbers such as 3.14 are
+# kept whole, closing quotes stay with their sentence, and a sentence only ends before a word that
+# does not start in lowercase.
+def split_sentences(text):
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.group(2).islower():
+            continue
+        if match.group().startswith('.'):
+            words = text[start:match.start()].split()
+            word = words[-1].lstrip('"\'“‘«([') if words else ''
+            if word.lower() in SENTENCE_ABBREVIATIONS or '.' in word or (len(word) == 1 and word.isupper()):
+                continue
+            if word.lower() in NUMBERING_ABBREVIATIONS and match.group(2).isdigit():
+                continue
+
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
     return sentences
 
-# Writes a list of dictionaries to a CSV file
+# Groups items into consecutive lists whose total size, as given by size, stays within budget.
+# An item larger than the budget gets a list of its own.
+def iter_packed_batches(items, budget, size=len):
+    batch, batch_size = [], 0
+    for item in items:
+        item_size = size(item)
+        if batch and batch_size + item_size > budget:
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(item)
+        batch_size += item_size
+    if batch:
+        yield batch
+
+# Groups the items of an iterable into lists of up to size items
+def iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Splits each paragraph of a chunk of (source, paragraph) pairs into (source, sentence) pairs
+def segment_chunk(chunk):
+    return [(source, sentence) for source, paragraph in chunk for sentence in split_sentences(paragraph)]
+
+def iter_segmented_chunks(pool, chunks, max_in_flight):
+    with pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(segment_chunk, (chunk,)))
+            if len(pending) >= max_in_flight:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+# Lazily splits (source, paragraph) pairs into (source, sentence) pairs, keeping their order.
+# Chunks of paragraphs are segmented in parallel by a process pool, with a bounded number of chunks
+# in flight. With processes=1, paragraphs are segmented one by one in this process, which suits slow
+# streams such as stdin. The pool is created here, before the pipeline starts any threads.
+def segment_sentences(sentences, processes=None, chunk_size=SEGMENT_CHUNK_SIZE):
+    if processes == 1:
+        return (pair for paragraph in sentences for pair in segment_chunk([paragraph]))
+    processes = processes or cpu_count()
+    return iter_segmented_chunks(Pool(processes), iter_chunks(sentences, chunk_size), processes * 2)
+
+# Sentences longer than this are rejected
+MAX_SENTENCE_LENGTH = int(os.getenv('MAX_SENTENCE_LENGTH', 500))
+NORMALIZE_BATCH_SIZE = 10000
+
+# Invisible characters removed by normalization: control characters other than whitespace, and format
+# characters such as zero-width spaces, soft hyphens and byte order marks. Whitespace is collapsed instead.
+INVISIBLE_CHARACTERS = dict.fromkeys(
+    [c for c in [*range(0x00, 0x20), *range(0x7f, 0xa0)] if not chr(c).isspace()]
+    + [0xad, 0x200b, 0x200e, 0x200f, 0x2060, 0xfeff])
+del INVISIBLE_CHARACTERS[0x00]
+
+# Normalizes a batch of texts at once: Unicode NFC, invisible characters removed and whitespace
+# collapsed to single spaces. The batch is joined into one string with NUL separators, so that
+# character removal and NFC are single passes over the whole batch instead of one call per text.
+def normalize_batch(texts):
+    if not texts:
+        return []
+    joined = '\x00'.join(texts)
+    if joined.count('\x00') != len(texts) - 1:
+        return [normalize_batch([text.replace('\x00', '')])[0] for text in texts]
+
+    joined = unicodedata.normalize('NFC', joined.translate(INVISIBLE_CHARACTERS))
+    return [' '.join(text.split()) for text in joined.split('\x00')]
+
+# Returns why a normalized sentence is rejected, or None if it is accepted
+def rejection_reason(sentence, max_length=MAX_SENTENCE_LENGTH):
+    if not sentence:
+        return 'empty'
+    if len(sentence) > max_length:
+        return 'too_long'
+    return None
+
+# Lazily normalizes (source, sentence) pairs in batches and drops the sentences that cannot become cards.
+# Rejected sentences are written to reject_file_name, if given, as a TSV file with the reason; the file
+# of a previous run is removed first, so it only exists when this run rejects sentences.
+def normalize_sentences(sentences, reject_file_name=None, max_length=MAX_SENTENCE_LENGTH, batch_size=NORMALIZE_BATCH_SIZE):
+    rejected = 0
+    if reject_file_name:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(reject_file_name)
+    with contextlib.ExitStack() as stack:
+        reject_writer = None
+        for batch in iter_chunks(sentences, batch_size):
+            normalized = normalize_batch([sentence for _, sentence in batch])
+            for (source, original), sentence in zip(batch, normalized):
+                reason = rejection_reason(sentence, max_length)
+                if reason is None:
+                    yield source, sentence
+                    continue
+
+                rejected += 1
+                if reject_file_name:
+                    if reject_writer is None:
+                        reject_file = stack.enter_context(open(reject_file_name, 'w', newline=''))
+                        reject_writer = csv.writer(reject_file, delimiter='\t')
+                        reject_writer.writerow(['source', 'reason', 'sentence'])
+                    reject_writer.writerow([source, reason, original])
+
+    logger.info(f'Rejected {rejected} sentences during normalization.')
+
+# Normalizations applied to sentences before comparing them for duplicates
+DEDUP_NORMALIZATIONS = ('case', 'whitespace', 'punctuation')
+TRAILING_PUNCTUATION = string.punctuation + '…¡¿“”‘’«»'
+
+# Normalizes a sentence for duplicate detection using the given normalizations
+def normalize_for_dedup(sentence, normalizations=DEDUP_NORMALIZATIONS):
+    if 'whitespace' in normalizations:
+        sentence = ' '.join(sentence.split())
+    if 'punctuation' in normalizations:
+        sentence = sentence.rstrip(TRAILING_PUNCTUATION + string.whitespace)
+    if 'case' in normalizations:
+        sentence = sentence.casefold()
+    return sentence
+
+# Lazily drops sentences whose normalized form was already seen, keeping the original order.
+# Only a 64-bit hash of each normalized sentence is kept, so memory stays bounded on large inputs.
+# If given, key extracts the sentence from each item, e.g. from (file_name, sentence) pairs.
+def dedup_sentences(sentences, normalizations=DEDUP_NORMALIZATIONS, key=None):
+    unknown = set(normalizations) - set(DEDUP_NORMALIZATIONS)
+    if unknown:
+        raise ValueError(f'Unknown dedup normalizations: {", ".join(sorted(unknown))}.')
+
+    seen = set()
+    dropped = 0
+    for sentence in sentences:
+        normalized = normalize_for_dedup(key(sentence) if key else sentence, normalizations)
+        digest = int.from_bytes(hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest(), 'little')
+        if digest in seen:
+            dropped += 1
+            continue
+        seen.add(digest)
+        yield sentence
+
+    logger.info(f'Dropped {dropped} duplicate sentences.')
+
+# Writes an iterable of dictionaries to a CSV file, row by row, and returns the number of rows.
+# Writing to "-" sends the rows to stdout, flushing each one as soon as its card is ready.
 def write_csv_file(file_name, cards):
     logger.info('Writing CSV file.')
-    keys = cards[0].keys()
-    with open(file_name, 'w', newline='') as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
+    cards = iter(cards)
+    first_card = next(cards, None)
+    if first_card is None:
+        raise ValueError('There are no cards to write.')
+
+    to_stdout = file_name == STDOUT_FILE_NAME
+    with contextlib.nullcontext(sys.stdout) if to_stdout else open(file_name, 'w', newline='') as output_file:
+        dict_writer = csv.DictWriter(output_file, first_card.keys())
         dict_writer.writeheader()
-        dict_writer.writerows(cards)
+        num_cards = 0
+        for card in itertools.chain([first_card], cards):
+            dict_writer.writerow(card)
+            num_cards += 1
+            if to_stdout:
+                output_file.flush()
 
-# Creates an Anki deck from a list of card data, and saves it to an .apkg file.
-def create_anki_deck(deck_name, cards, output_file):
+    return num_cards
+
+# Builds an Anki tag from the name of the file a card came from
+def source_tag(source):
+    return slugify(os.path.splitext(os.path.basename(source))[0])
+
+# Creates an Anki deck from an iterable of card data, saves it to an .apkg file and returns the number of cards.
+def create_anki_deck(deck_name, cards, output_file, deck_id=None):
     logger.info('Creating Anki deck.')
 
     # Define the Anki model
@@ -82,16 +714,18 @@ def create_anki_deck(deck_name, cards, output_file):
 
     # Create the deck
     deck = genanki.Deck(
-        deck_id=anki_deck_id,
+        deck_id=deck_id or anki_deck_id,
         name=deck_name)
 
     # Add notes (cards) to the deck and collect audio file paths
     logger.info('Adding notes to the Anki deck.')
     media_files = []
     for card in cards:
+        tag = source_tag(card['Source']) if card.get('Source') else ''
         note = genanki.Note(
             model=model,
-            fields=[card['Front'], card['Back'], card.get('AudioTag', '')])
+            fields=[card['Front'], card['Back'], card.get('AudioTag', '')],
+            tags=[tag] if tag else [])
         deck.add_note(note)
         media_files.append(f"{card['AudioPath']}")
 
@@ -99,84 +733,947 @@ def create_anki_deck(deck_name, cards, output_file):
     genanki.Package(deck, media_files=media_files).write_to_file(output_file)
     logger.info(f"Anki deck saved as {output_file}")
 
+    return len(deck.notes)
+
+# Puts an item into a bounded queue, giving up if the stop event is set while waiting for space
+def put_until_stopped(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Iterates items in a background thread, running up to maxsize items ahead of the caller, so that
+# each stage of the card pipeline works concurrently with the next one. Errors are re-raised in
+# the caller, and the background thread stops when the caller stops iterating.
+def iter_in_background(items, maxsize):
+    buffer = queue.Queue(maxsize=maxsize)
+    stop_event = threading.Event()
+    end_of_stream = object()
+    errors = []
+
+    def run():
+        try:
+            for item in items:
+                if not put_until_stopped(buffer, item, stop_event):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+        put_until_stopped(buffer, end_of_stream, stop_event)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is end_of_stream:
+                if errors:
+                    raise errors[0]
+                return
+            yield item
+    finally:
+        stop_event.set()
+
+# Hands the i-th element of each item to the i-th consumer, which runs in its own thread on an iterator
+# of its elements, and returns the results of the consumers. Each consumer runs at most maxsize
+# elements behind the producer, and an error in the items or any consumer stops all of them.
+def fan_out(items, consumers, maxsize=MAX_CARDS_IN_FLIGHT):
+    if len(consumers) == 1:
+        return [consumers[0](item[0] for item in items)]
+
+    queues = [queue.Queue(maxsize=maxsize) for _ in consumers]
+    stop_event = threading.Event()
+    end_of_stream = object()
+
+    def iter_queue(q):
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if stop_event.is_set():
+                    return
+                continue
+            if item is end_of_stream:
+                return
+            yield item
+
+    with ThreadPoolExecutor(max_workers=len(consumers)) as executor:
+        futures = [executor.submit(consumer, iter_queue(q)) for consumer, q in zip(consumers, queues)]
+        for future in futures:
+            future.add_done_callback(lambda future: future.exception() and stop_event.set())
+        try:
+            for item in items:
+                if not all(put_until_stopped(q, element, stop_event) for q, element in zip(queues, item)):
+                    break
+            for q in queues:
+                put_until_stopped(q, end_of_stream, stop_event)
+        except BaseException:
+            stop_event.set()
+            raise
+    return [future.result() for future in futures]
+
+# Keeps the cards created for each input/output pair in an SQLite file, keyed on a fingerprint
+# of their source and sentence, so that reruns only create cards for new or changed sentences.
+class RunManifest:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cards (fingerprint TEXT PRIMARY KEY, card TEXT NOT NULL)')
+
+    # Returns the manifest file name of an output file name and a target language. Inputs are not part
+    # of it, as cards are keyed on their source file, so adding a file to the inputs keeps the manifest.
+    @staticmethod
+    def file_name_for(output_file_name, dest):
+        return f'{OUTPUT_DIR}/{output_file_name}.{dest}.manifest.sqlite3'
+
+    # Cards depend on the audio format too, so changing it creates the cards again with audio of the new format
+    @staticmethod
+    def fingerprint(source, sentence):
+        return hashlib.blake2b(f'{source}\0{sentence}\0{AUDIO_FORMAT}'.encode('utf-8'), digest_size=16).hexdigest()
+
+    # Returns the card created for a sentence in an earlier run, if it is still usable
+    def get(self, source, sentence):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT card FROM cards WHERE fingerprint = ?', (self.fingerprint(source, sentence),)).fetchone()
+        card = json.loads(row[0]) if row else None
+        if card is None or not os.path.exists(card['AudioPath']):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return card
+
+    def put(self, source, sentence, card):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cards (fingerprint, card) VALUES (?, ?)',
+                (self.fingerprint(source, sentence), json.dumps(card)))
+            self.uncommitted += 1
+            if self.uncommitted >= MANIFEST_COMMIT_INTERVAL:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+        logger.info(f'Reused {self.hits} cards from {self.file_name}, {self.misses} sentences were new or changed.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Counters shared by all threads and processes of a run, reported in the run summary
+RUN_STATS_FIELDS = ('translation_cache_hits', 'translation_cache_misses', 'translation_requests',
+                    'translation_retries', 'translation_breaker_trips', 'translation_memory_matches')
+
+class RunStats:
+    def __init__(self, fields=RUN_STATS_FIELDS):
+        self.fields = fields
+        self.values = Array('q', len(fields))
+
+    def increment(self, field, amount=1):
+        with self.values.get_lock():
+            self.values[self.fields.index(field)] += amount
+
+    def as_dict(self):
+        with self.values.get_lock():
+            return dict(zip(self.fields, self.values))
+
+    def summary(self):
+        return ', '.join(f'{field}={value}' for field, value in self.as_dict().items())
+
+run_stats = RunStats()
+
+# Token buckets of requests and characters per second, shared by all processes of a run through
+# shared memory. A caller takes its tokens right away, even when it drives a bucket below zero, and
+# then sleeps until the debt is repaid, so concurrent callers queue up behind each other and requests
+# leave at a steady pace of the configured rates instead of in bursts. A bucket holds up to one
+# second of its rate, and a rate of 0 disables it.
+class RateLimiter:
+    def __init__(self, requests_per_second=0, chars_per_second=0):
+        self.rates = (requests_per_second, chars_per_second)
+        # Tokens and time of the last update of each bucket
+        self.state = Array('d', [requests_per_second, time.monotonic(), chars_per_second, time.monotonic()])
+
+    def acquire(self, chars=0):
+        wait = 0
+        with self.state.get_lock():
+            now = time.monotonic()
+            for i, (rate, amount) in enumerate(zip(self.rates, (1, chars))):
+                if rate:
+                    tokens = min(rate, self.state[2 * i] + (now - self.state[2 * i + 1]) * rate) - amount
+                    self.state[2 * i], self.state[2 * i + 1] = tokens, now
+                    wait = max(wait, -tokens / rate)
+        if wait > 0:
+            time.sleep(wait)
+
+rate_limiters = {backend: RateLimiter(*limits) for backend, limits in RATE_LIMITS.items()}
+
+# Groups (source, sentence) pairs into batches of up to max_batch_chars characters and max_batch_size
+# sentences to translate. Each batch is a list of (source, sentence, cards) entries, where cards has
+# the card found in each of card_caches, or None where the sentence still has to be translated.
+def iter_card_batches(sentences, card_caches=(None,), max_batch_chars=TRANSLATION_BATCH_CHARS, max_batch_size=TRANSLATION_BATCH_SIZE):
+    batch, batch_chars = [], 0
+    for source, sentence in sentences:
+        cards = [card_cache.get(source, sentence) if card_cache else None for card_cache in card_caches]
+        missing = None in cards
+        if missing and batch_chars and batch_chars + len(sentence) > max_batch_chars:
+            yield batch
+            batch, batch_chars = [], 0
+        batch.append((source, sentence, cards))
+        if missing:
+            batch_chars += len(sentence) + 1
+        if len(batch) >= max_batch_size:
+            yield batch
+            batch, batch_chars = [], 0
+    if batch:
+        yield batch
+
+# Translates (source, sentence) pairs as they arrive from an iterable into every language of dests and
+# yields, in input order, a list with the card of each language. The pipeline has three stages running
+# concurrently: sentences are packed into batches and sent to the asyncio translation engine, once per
+# language, which keeps up to translation_concurrency requests in flight; one audio task per sentence
+# (or, with speech_batch_chars, per SSML batch of sentences of the same voice), shared by all its
+# cards, is submitted to a pool of speech_concurrency threads, each with its own speech synthesizer,
+# whose connections are closed at the end; and the caller consumes finished cards. Synthesis mostly
+# waits on the speech service, so threads keep many requests in flight without a process per request.
+# At most about max_in_flight sentences wait for their audio at any time, so memory use stays flat.
+# Cards found in the card cache of their language (a RunManifest) are reused; new cards are added.
+def iter_card_sets_in_parallel(sentences, dests=('pt',), card_caches=None, max_in_flight=MAX_CARDS_IN_FLIGHT,
+                               max_batch_chars=TRANSLATION_BATCH_CHARS, max_batch_size=TRANSLATION_BATCH_SIZE,
+                               translation_concurrency=TRANSLATION_CONCURRENCY, speech_concurrency=SPEECH_CONCURRENCY,
+                               speech_batch_chars=SPEECH_BATCH_CHARS):
+    card_caches = card_caches or [None] * len(dests)
+    logger.info('Initializing translation.')
+    with TranslationEngine(concurrency=translation_concurrency, max_chars=max_batch_chars, cache_file=translation_cache_file(),
+                           memory_file=translation_memory_file()) as engine, contextlib.ExitStack() as stack, \
+            ThreadPoolExecutor(max_workers=speech_concurrency, thread_name_prefix='speech') as speech_executor:
+        # Close the connections of the speech synthesizers once the speech threads are done
+        stack.callback(close_speech_synthesizers)
+        def translate_batches():
+            for batch in iter_card_batches(sentences, card_caches, max_batch_chars, max_batch_size):
+                translations = []
+                for i, dest in enumerate(dests):
+                    to_translate = [sentence for _, sentence, cards in batch if cards[i] is None]
+                    translations.append(engine.submit(to_translate, dest) if to_translate else None)
+                yield batch, translations
+
+        # Buffered SSML batches are sent before the queue of pending card batches can fill up behind them
+        max_pending_batches = max(1, max_in_flight // max_batch_size)
+        speech_batcher = SpeechBatcher(speech_executor, speech_batch_chars, max_age=max_pending_batches)
+
+        def synthesize_batches(translated_batches):
+            for batch, translations in translated_batches:
+                speech_batcher.next_card_batch()
+                audios = [speech_batcher.submit(sentence) if None in cards else None for _, sentence, cards in batch]
+                yield batch, translations, audios
+            speech_batcher.flush()
+
+        translated_batches = iter_in_background(translate_batches(), maxsize=max(1, translation_concurrency))
+        pending_batches = iter_in_background(synthesize_batches(translated_batches), maxsize=max_pending_batches)
+        for batch, translations, audios in pending_batches:
+            translations = [iter(translation.result()) if translation else None for translation in translations]
+            for (source, sentence, cards), audio in zip(batch, audios):
+                if audio is not None:
+                    audio_file_name, audio_file_path = speech_batcher.result(audio)
+                    for i, card_cache in enumerate(card_caches):
+                        if cards[i] is None:
+                            cards[i] = build_card(sentence, next(translations[i]), audio_file_name, audio_file_path, source)
+                            if card_cache:
+                                card_cache.put(source, sentence, cards[i])
+                yield cards
+
+# Translates (source, sentence) pairs into a single language and yields their cards in input order
+def iter_cards_in_parallel(sentences, max_in_flight=MAX_CARDS_IN_FLIGHT, card_cache=None,
+                           max_batch_chars=TRANSLATION_BATCH_CHARS, max_batch_size=TRANSLATION_BATCH_SIZE,
+                           translation_concurrency=TRANSLATION_CONCURRENCY, speech_concurrency=SPEECH_CONCURRENCY, dest='pt',
+                           speech_batch_chars=SPEECH_BATCH_CHARS):
+    card_sets = iter_card_sets_in_parallel(sentences, (dest,), [card_cache], max_in_flight, max_batch_chars,
+                                           max_batch_size, translation_concurrency, speech_concurrency,
+                                           speech_batch_chars)
+    for cards in card_sets:
+        yield cards[0]
+
 # Translates a list of sentences and creates a list of cards with translations and audio tags
 def create_cards_in_parallel(sentences):
-    logger.info('Initializing translation.')
-    with Pool(cpu_count()) as pool:
-        cards = pool.map(partial(create_card), sentences)
-    return cards
+    return list(iter_cards_in_parallel((None, sentence) for sentence in sentences))
 
-# Translates a sentence, generates an audio tag, and creates a card with the translation and audio
-def create_card(sentence):
+# Translates a sentence, generates an audio tag, and creates a card with the translation and audio.
+# The source file, if known, is kept on the card so decks can be grouped or tagged by it.
+def create_card(sentence, source=None):
     logger.info(f'Creating card for "{sentence}".')
     sentence_translated = translate(sentence)
     audio_file_name, audio_file_path  = generate_audio(sentence) 
-    
+    return build_card(sentence, sentence_translated, audio_file_name, audio_file_path, source)
+
+# Creates a card from a sentence, its translation and its audio file
+def build_card(sentence, sentence_translated, audio_file_name, audio_file_path, source=None):
     card = {
         "Front": sentence,
         "Back": sentence_translated,
-        "AudioTag": f"[sound:{audio_file_name}.mp3]",
+        "AudioTag": f"[sound:{os.path.basename(audio_file_path)}]",
         "AudioPath": audio_file_path
     }
+    if source is not None:
+        card["Source"] = source
 
     return card
 
-# Translate text
+# Persistent translation cache keyed on (src, dest, text). Every process opens its own connection;
+# WAL mode lets readers run while another worker writes, and each write is committed at once.
+class TranslationCache:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS translations ('
+            'src TEXT NOT NULL, dest TEXT NOT NULL, text TEXT NOT NULL, translation TEXT NOT NULL, '
+            'PRIMARY KEY (src, dest, text)) WITHOUT ROWID')
+
+    def get(self, text, src, dest):
+        row = self.connection.execute(
+            'SELECT translation FROM translations WHERE src = ? AND dest = ? AND text = ?', (src, dest, text)).fetchone()
+        return row[0] if row else None
+
+    def put(self, text, src, dest, translation):
+        self.put_many([(text, translation)], src, dest)
+
+    # Stores (text, translation) pairs in a single transaction
+    def put_many(self, pairs, src, dest):
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO translations (src, dest, text, translation) VALUES (?, ?, ?, ?)',
+                ((src, dest, text, translation) for text, translation in pairs))
+
+    # Loads the (text, translation) rows of a TSV file, such as a parallel corpus, into the cache in
+    # bulk and returns the number of rows loaded. Texts are normalized like input sentences so that
+    # they match the sentences looked up later.
+    def import_tsv(self, file_name, src, dest, chunk_size=TRANSLATION_IMPORT_CHUNK_SIZE):
+        imported = 0
+        with open_input_file(file_name, newline='') as tsv_file:
+            rows = (row for row in csv.reader(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE) if len(row) >= 2)
+            for chunk in iter_chunks(rows, chunk_size):
+                pairs = [(text, translation) for text, translation
+                         in zip(normalize_batch([row[0] for row in chunk]), normalize_batch([row[1] for row in chunk]))
+                         if text and translation]
+                self.put_many(pairs, src, dest)
+                imported += len(pairs)
+        return imported
+
+    # Writes the cached (text, translation) pairs of a language pair to a TSV file, or to stdout for "-",
+    # in the format import_tsv reads, and returns the number of rows written
+    def export_tsv(self, file_name, src, dest):
+        rows = self.connection.execute('SELECT text, translation FROM translations WHERE src = ? AND dest = ?', (src, dest))
+        to_stdout = file_name == STDOUT_FILE_NAME
+        with contextlib.nullcontext(sys.stdout) if to_stdout else open(file_name, 'w', newline='', encoding='utf-8') as tsv_file:
+            exported = 0
+            for row in rows:
+                tsv_file.write('\t'.join(' '.join(value.split()) for value in row) + '\n')
+                exported += 1
+        return exported
+
+    def close(self):
+        self.connection.close()
+
+# Word unigrams and bigrams of a text, compared to find near-duplicate sentences. Bigrams keep
+# sentences with the same words in a different order apart.
+def text_shingles(text):
+    words = re.findall(r'\w+', text.casefold())
+    return set(words) | {f'{a} {b}' for a, b in zip(words, words[1:])}
+
+# Coefficients of the MinHash functions (a * h + b) % MINHASH_PRIME, derived from fixed seeds so the
+# signatures stored in the translation memory stay valid across runs and Python versions
+def minhash_coefficient(seed):
+    return int.from_bytes(hashlib.blake2b(seed.encode('utf-8'), digest_size=8).digest(), 'big') % (MINHASH_PRIME - 1) + 1
+
+MINHASH_COEFFICIENTS = [(minhash_coefficient(f'a{i}'), minhash_coefficient(f'b{i}')) for i in range(MINHASH_PERMUTATIONS)]
+
+# MinHash signature of a set of shingles: for each hash function, the minimum hash of the shingles
+def minhash(shingles):
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big') for shingle in shingles]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_COEFFICIENTS]
+
+# LSH keys of a text: one 64-bit hash per band of its MinHash signature. Texts sharing a key are
+# candidates for near-duplicates; with the default bands, texts with a similarity of 0.7 share a
+# key with a probability above 99.9%.
+def lsh_keys(shingles, src, dest):
+    signature = minhash(shingles)
+    return [int.from_bytes(hashlib.blake2b(f'{src}\0{dest}\0{band}\0{signature[band:band + MINHASH_BAND_SIZE]}'.encode('utf-8'),
+                                           digest_size=8).digest(), 'big', signed=True)
+            for band in range(0, MINHASH_PERMUTATIONS - MINHASH_BAND_SIZE + 1, MINHASH_BAND_SIZE)]
+
+# Translation memory that finds past translations of near-duplicate sentences with MinHash LSH. Each
+# entry is indexed under its band keys in SQLite, so a lookup is a handful of indexed queries plus an
+# exact comparison of the candidates sharing the most keys, however many entries the memory holds.
+# Every match above the threshold is appended to the matches file for review, and its translation is
+# returned for reuse.
+class TranslationMemory:
+    def __init__(self, file_name, threshold=None, matches_file_name=None):
+        self.file_name = file_name
+        self.threshold = TRANSLATION_MEMORY_THRESHOLD if threshold is None else threshold
+        self.matches_file_name = matches_file_name or TRANSLATION_MEMORY_MATCHES_FILE
+        self.matches_lock = threading.Lock()
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, src TEXT NOT NULL, dest TEXT NOT NULL, '
+            'text TEXT NOT NULL, translation TEXT NOT NULL, UNIQUE (src, dest, text))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bands (key INTEGER NOT NULL, entry INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS bands_key ON bands (key)')
+
+    # Returns (similarity, text, translation) of the most similar entry above the threshold, or None
+    def find(self, text, src, dest):
+        shingles = text_shingles(text)
+        if not shingles:
+            return None
+        keys = lsh_keys(shingles, src, dest)
+        candidates = self.connection.execute(
+            f'SELECT entries.text, entries.translation FROM entries JOIN ('
+            f'SELECT entry FROM bands WHERE key IN ({", ".join("?" * len(keys))}) GROUP BY entry ORDER BY COUNT(*) DESC LIMIT ?'
+            f') AS candidates ON entries.id = candidates.entry', (*keys, TRANSLATION_MEMORY_CANDIDATES)).fetchall()
+        best = None
+        for candidate_text, translation in candidates:
+            candidate_shingles = text_shingles(candidate_text)
+            similarity = len(shingles & candidate_shingles) / len(shingles | candidate_shingles)
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, candidate_text, translation)
+        if best:
+            self.record_match(text, dest, *best)
+        return best
+
+    def record_match(self, text, dest, similarity, matched_text, translation):
+        with self.matches_lock:
+            is_new = not os.path.exists(self.matches_file_name)
+            with open(self.matches_file_name, 'a', newline='', encoding='utf-8') as matches_file:
+                writer = csv.writer(matches_file, delimiter='\t')
+                if is_new:
+                    writer.writerow(['dest', 'similarity', 'sentence', 'match', 'translation'])
+                writer.writerow([dest, f'{similarity:.2f}', text, matched_text, translation])
+
+    # Adds (text, translation) pairs to the memory in a single transaction
+    def put_many(self, pairs, src, dest):
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for text, translation in pairs:
+                shingles = text_shingles(text)
+                cursor = self.connection.execute(
+                    'INSERT OR IGNORE INTO entries (src, dest, text, translation) VALUES (?, ?, ?, ?)', (src, dest, text, translation))
+                if shingles and cursor.rowcount:
+                    self.connection.executemany('INSERT INTO bands (key, entry) VALUES (?, ?)',
+                                                ((key, cursor.lastrowid) for key in lsh_keys(shingles, src, dest)))
+
+    def close(self):
+        self.connection.close()
+
+# Interface of translation backends. A backend translates a single text or a batch of texts, returning
+# one translation per text; a batch result of a different length means it could not be aligned with
+# the texts, and they are translated one by one instead. Backends whose translations are not worth
+# keeping (e.g. stand-ins for tests) set cacheable to False.
+class TranslationBackend(ABC):
+    cacheable = True
+    # Errors after which a request is retried; backends that can tell permanent errors apart narrow it
+    transient_errors = (Exception,)
+    # Whether batches are sent with translate_batch; backends whose batches cannot be aligned turn it off
+    batching = True
+
+    @abstractmethod
+    def translate(self, text, src, dest):
+        pass
+
+    def translate_batch(self, texts, src, dest):
+        return [self.translate(text, src, dest) for text in texts]
+
+# Google Translate through googletrans. Batches are sent as a single request with one text per line.
+class GoogleTranslationBackend(TranslationBackend):
+    def __init__(self):
+        self.translator = Translator()
+
+    def translate(self, text, src, dest):
+        return self.translator.translate(text, src=src, dest=dest).text
+
+    # googletrans rebuilds the translation from the parts of the response, joined with spaces, so line
+    # breaks do not always survive. Once a batch comes back misaligned, this backend stops batching
+    # instead of wasting a request on every batch before translating its texts one by one.
+    def translate_batch(self, texts, src, dest):
+        translation = self.translate('\n'.join(text.replace('\n', ' ') for text in texts), src, dest)
+        translations = [line.strip() for line in translation.split('\n')]
+        if len(translations) != len(texts):
+            logger.warning('Google Translate did not keep the line breaks of a batch, translating sentences one by one from now on.')
+            self.batching = False
+        return translations
+
+# Deterministic backend that works offline, for benchmarks and CI: texts found in a lookup table are
+# translated with it and the others are returned unchanged, after an artificial per-request latency
+class OfflineTranslationBackend(TranslationBackend):
+    cacheable = False
+
+    def __init__(self, table_file_name=None, latency=None):
+        table_file_name = table_file_name or OFFLINE_TRANSLATION_FILE
+        self.latency = OFFLINE_TRANSLATION_LATENCY if latency is None else latency
+        self.table = {}
+        if table_file_name:
+            with open(table_file_name, newline='', encoding='utf-8') as file:
+                self.table = {row[0]: row[1] for row in csv.reader(file, delimiter='\t') if len(row) >= 2}
+
+    def translate(self, text, src, dest):
+        return self.translate_batch([text], src, dest)[0]
+
+    def translate_batch(self, texts, src, dest):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.table.get(text, text) for text in texts]
+
+TRANSLATION_BACKENDS = {
+    'google': GoogleTranslationBackend,
+    'offline': OfflineTranslationBackend,
+}
+
+# Returns the backend class for a name from TRANSLATION_BACKENDS or a 'module:Class' import path
+def get_translation_backend_class(name=None):
+    name = name or TRANSLATION_BACKEND
+    if name in TRANSLATION_BACKENDS:
+        return TRANSLATION_BACKENDS[name]
+    if ':' not in name:
+        raise ValueError(f"Unknown translation backend '{name}', expected one of {', '.join(TRANSLATION_BACKENDS)} or 'module:Class'.")
+    module_name, class_name = name.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+# Creates a backend, which has to be a TranslationBackend so backends missing translate() fail here
+def create_translation_backend(name=None):
+    backend_class = get_translation_backend_class(name)
+    if not (isinstance(backend_class, type) and issubclass(backend_class, TranslationBackend)):
+        raise TypeError(f"Translation backend {backend_class!r} is not a subclass of TranslationBackend.")
+    return backend_class()
+
+# Returns the translation cache file, or None if the configured backend is not cacheable
+def translation_cache_file():
+    return TRANSLATION_CACHE_FILE if getattr(get_translation_backend_class(), 'cacheable', True) else None
+
+# Returns the translation memory file, or None if the memory is off or the configured backend is not cacheable
+def translation_memory_file():
+    if TRANSLATION_MEMORY not in TRANSLATION_MEMORY_MODES:
+        raise ValueError(f"Unknown translation memory mode '{TRANSLATION_MEMORY}', expected one of {', '.join(TRANSLATION_MEMORY_MODES)}.")
+    if TRANSLATION_MEMORY == 'off' or not getattr(get_translation_backend_class(), 'cacheable', True):
+        return None
+    return TRANSLATION_MEMORY_FILE
+
+# Translation backend of each thread, whose client keeps its connections alive between requests
+translation_backend_state = threading.local()
+
+# Returns the translation backend of the current thread, creating it on first use
+def get_translation_backend():
+    backend = getattr(translation_backend_state, 'backend', None)
+    if backend is None:
+        backend = translation_backend_state.backend = create_translation_backend()
+    return backend
+
+# Translate text, looking it up in the translation cache and memory first
 def translate(text, src='en', dest='pt'):
-    translator = Translator()
-    translation = translator.translate(text, src=src, dest=dest)
-    return translation.text
+    return translate_batch([text], src=src, dest=dest)[0]
 
-# Generates the SpeechConfig with a random voice
-def get_speech_config_with_random_voice():
-    # Available English US voices
-    english_us_voices = [
-        "en-US-AmberNeural",
-        "en-US-AriaNeural",
-        "en-US-AshleyNeural",
-        "en-US-BrandonNeural",
-        "en-US-ChristopherNeural",
-        "en-US-CoraNeural",
-        "en-US-DavisNeural",
-        "en-US-ElizabethNeural",
-        "en-US-EricNeural",
-        "en-US-GuyNeural",
-        "en-US-JacobNeural",
-        "en-US-JaneNeural",
-        "en-US-JasonNeural",
-        "en-US-JennyNeural",
-        "en-US-MichelleNeural",
-        "en-US-MonicaNeural",
-        "en-US-NancyNeural",
-        "en-US-SaraNeural",
-        "en-US-SteffanNeural",
-        "en-US-TonyNeural",
-    ]
-
-    # Choose a random English US voice
-    random_voice = random.choice(english_us_voices)
+# Circuit breaker of the translation requests of a process. While it is closed, requests go through
+# and their outcomes are recorded in a sliding window; when the share of failures in the window
+# reaches error_rate, it opens and every request waits for the cooldown instead of hammering a
+# failing service. After the cooldown a single trial request goes through: if it succeeds the
+# breaker closes again, otherwise it opens for another cooldown.
+class CircuitBreaker:
+    def __init__(self, window=TRANSLATION_BREAKER_WINDOW, error_rate=TRANSLATION_BREAKER_ERROR_RATE,
+                 cooldown=TRANSLATION_BREAKER_COOLDOWN):
+        self.outcomes = deque(maxlen=window)
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.open_until = None
+        self.trial_running = False
+        self.condition = threading.Condition()
+
+    # Waits until a request may go through, returning whether it is the trial request of an open breaker
+    def wait(self):
+        with self.condition:
+            while True:
+                if self.open_until is None:
+                    return False
+                remaining = self.open_until - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                elif self.trial_running:
+                    self.condition.wait()
+                else:
+                    self.trial_running = True
+                    return True
+
+    def record(self, success, trial=False):
+        with self.condition:
+            if trial:
+                self.trial_running = False
+                if success:
+                    logger.info('Translation requests succeed again, resuming translation.')
+                    self.open_until = None
+                    self.outcomes.clear()
+                else:
+                    self.trip()
+                self.condition.notify_all()
+            elif self.open_until is None:
+                # Outcomes of requests sent before the breaker opened are ignored
+                self.outcomes.append(success)
+                failures = self.outcomes.count(False)
+                if len(self.outcomes) == self.outcomes.maxlen and failures >= self.error_rate * len(self.outcomes):
+                    self.trip()
+
+    def trip(self):
+        self.open_until = time.monotonic() + self.cooldown
+        run_stats.increment('translation_breaker_trips')
+        logger.warning(f'Too many failed translation requests, pausing translation for {self.cooldown:.0f} seconds.')
+
+translation_breaker = CircuitBreaker()
+
+# Sends one request with a text or a batch of texts to the translation backend, respecting the rate limit
+# and the circuit breaker, and retries it after transient errors with exponential backoff and full jitter
+def send_translation_request(texts, src, dest):
+    backend = get_translation_backend()
+    for attempt in itertools.count():
+        trial = translation_breaker.wait()
+        rate_limiters['translation'].acquire(sum(len(text) + 1 for text in texts) - 1)
+        run_stats.increment('translation_requests')
+        try:
+            if len(texts) == 1:
+                result = [backend.translate(texts[0], src, dest)]
+            else:
+                result = backend.translate_batch(texts, src, dest)
+        except getattr(backend, 'transient_errors', (Exception,)) as e:
+            translation_breaker.record(False, trial)
+            if attempt >= TRANSLATION_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(TRANSLATION_RETRY_MAX_DELAY, TRANSLATION_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning(f'Translation request failed ({e!r}), retrying in {delay:.1f} seconds.')
+            run_stats.increment('translation_retries')
+            time.sleep(delay)
+        except BaseException:
+            # Permanent errors are not retried, but still release the trial of an open breaker
+            translation_breaker.record(False, trial)
+            raise
+        else:
+            translation_breaker.record(True, trial)
+            return result
+
+# Translates several texts in one request of the translation backend. If the backend does not
+# return one translation per text, each text is translated on its own so translations never end up
+# on the wrong card; backends that turned batching off get one request per text right away.
+def translate_joined(texts, src='en', dest='pt'):
+    if len(texts) > 1 and not getattr(get_translation_backend(), 'batching', True):
+        return [translate_joined([text], src=src, dest=dest)[0] for text in texts]
+    translations = send_translation_request(texts, src, dest)
+    if len(translations) == len(texts):
+        return translations
+
+    logger.warning(f'Batch translation returned {len(translations)} lines for {len(texts)} sentences, translating them one by one.')
+    return [translate_joined([text], src=src, dest=dest)[0] for text in texts]
+
+# Looks texts up in a translation cache, returning their translations with None for the missing ones
+def lookup_cached_translations(texts, src, dest, cache):
+    translations = [None] * len(texts)
+    if cache:
+        for i, text in enumerate(texts):
+            translations[i] = cache.get(text, src, dest)
+        hits = sum(translation is not None for translation in translations)
+        run_stats.increment('translation_cache_hits', hits)
+        run_stats.increment('translation_cache_misses', len(texts) - hits)
+    return translations
+
+# Looks the texts that have no translation yet up in the translation memory, filling in the
+# translations of their near-duplicates when the memory is set to reuse them
+def lookup_memory_translations(texts, translations, src, dest, memory):
+    if not memory:
+        return
+    for i, text in enumerate(texts):
+        if translations[i] is None:
+            match = memory.find(text, src, dest)
+            if match:
+                run_stats.increment('translation_memory_matches')
+                if TRANSLATION_MEMORY == 'reuse':
+                    translations[i] = match[2]
+
+# Packs the texts that have no translation yet into requests of up to max_chars characters,
+# returning lists of indices into texts
+def pack_translation_requests(texts, translations, max_chars):
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+    return list(iter_packed_batches(missing, max_chars, size=lambda i: len(texts[i]) + 1))
+
+# Translation engines shared by the translate_batch calls of a process, created on first use for each
+# source language, batch budget, cache and memory, so translating card by card reuses their backends,
+# threads and database connections instead of setting them up for every sentence
+translation_engines = {}
+translation_engines_lock = threading.Lock()
+
+def get_translation_engine(src='en', max_chars=TRANSLATION_BATCH_CHARS):
+    key = (src, max_chars, translation_cache_file(), translation_memory_file())
+    with translation_engines_lock:
+        if key not in translation_engines:
+            translation_engines[key] = TranslationEngine(src, max_chars=max_chars, cache_file=key[2], memory_file=key[3])
+        return translation_engines[key]
+
+# Closes the shared translation engines
+def close_translation_engines():
+    with translation_engines_lock:
+        engines = list(translation_engines.values())
+        translation_engines.clear()
+    for engine in engines:
+        engine.close()
+
+# Translates a list of texts outside the card pipeline with a shared translation engine, so they are
+# looked up in the translation cache and memory first, and the remaining ones are packed into as few
+# requests of up to max_chars characters as possible
+def translate_batch(texts, src='en', dest='pt', max_chars=TRANSLATION_BATCH_CHARS):
+    return get_translation_engine(src, max_chars).submit(texts, dest).result()
+
+# Translation stage of the card pipeline. An asyncio event loop in a background thread translates
+# batches submitted from any thread, keeping up to concurrency requests in flight in this process.
+# Translation backends are blocking, so each request runs on a thread of the loop's executor, with
+# its own backend. The translation cache is only used from the loop thread, and the translation
+# memory, whose lookups take longer, from a thread of its own so it does not hold up the loop.
+class TranslationEngine:
+    def __init__(self, src='en', dest='pt', concurrency=TRANSLATION_CONCURRENCY, max_chars=TRANSLATION_BATCH_CHARS, cache_file=None,
+                 memory_file=None):
+        # Every request thread creates its own backend; creating one here fails on a misconfigured backend
+        # before any request is sent instead of mid-run
+        create_translation_backend()
+        self.src = src
+        self.dest = dest
+        self.max_chars = max_chars
+        self.cache = TranslationCache(cache_file) if cache_file else None
+        self.memory = TranslationMemory(memory_file) if memory_file else None
+        self.memory_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='translation-memory')
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='translation')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # Created on the loop thread, as asyncio primitives bind to the running loop before Python 3.10
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.create_semaphore(concurrency), self.loop).result()
+
+    @staticmethod
+    async def create_semaphore(concurrency):
+        return asyncio.Semaphore(concurrency)
+
+    # Submits a list of texts to translate into dest (default: the engine's), returning a
+    # concurrent.futures.Future of their translations
+    def submit(self, texts, dest=None):
+        return asyncio.run_coroutine_threadsafe(self.translate(texts, dest or self.dest), self.loop)
+
+    async def translate(self, texts, dest):
+        translations = lookup_cached_translations(texts, self.src, dest, self.cache)
+        if self.memory:
+            await self.loop.run_in_executor(self.memory_executor, lookup_memory_translations, texts, translations, self.src, dest, self.memory)
+        requests = pack_translation_requests(texts, translations, self.max_chars)
+        results = await asyncio.gather(*(self.request([texts[i] for i in request], dest) for request in requests))
+        for request, request_translations in zip(requests, results):
+            for i, translation in zip(request, request_translations):
+                translations[i] = translation
+            if self.cache:
+                self.cache.put_many(zip((texts[i] for i in request), request_translations), self.src, dest)
+            if self.memory:
+                pairs = list(zip((texts[i] for i in request), request_translations))
+                await self.loop.run_in_executor(self.memory_executor, self.memory.put_many, pairs, self.src, dest)
+        return translations
+
+    async def request(self, texts, dest):
+        async with self.semaphore:
+            return await self.loop.run_in_executor(self.executor, translate_joined, texts, self.src, dest)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.memory_executor.shutdown(cancel_futures=True)
+        self.loop.close()
+        if self.cache:
+            self.cache.close()
+        if self.memory:
+            self.memory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Available English US voices
+ENGLISH_US_VOICES = [
+    "en-US-AmberNeural",
+    "en-US-AriaNeural",
+    "en-US-AshleyNeural",
+    "en-US-BrandonNeural",
+    "en-US-ChristopherNeural",
+    "en-US-CoraNeural",
+    "en-US-DavisNeural",
+    "en-US-ElizabethNeural",
+    "en-US-EricNeural",
+    "en-US-GuyNeural",
+    "en-US-JacobNeural",
+    "en-US-JaneNeural",
+    "en-US-JasonNeural",
+    "en-US-JennyNeural",
+    "en-US-MichelleNeural",
+    "en-US-MonicaNeural",
+    "en-US-NancyNeural",
+    "en-US-SaraNeural",
+    "en-US-SteffanNeural",
+    "en-US-TonyNeural",
+]
+SPEECH_LANGUAGE = "en-US"
+
+# Audio output format of the speech synthesis, part of the audio cache key. Compact formats such as
+# low-bitrate mono MP3 or Opus make the audio cache and the decks several times smaller.
+AUDIO_FORMAT = os.getenv('AUDIO_FORMAT', 'sdk-default')
+
+# Supported audio output formats, named like the speech service names them, with their file extension.
+# The SDK default (PCM/WAV) keeps the .mp3 extension of the files cached before formats were configurable.
+AUDIO_FORMATS = {
+    'sdk-default': (None, 'mp3'),
+    'audio-16khz-32kbitrate-mono-mp3': (SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3, 'mp3'),
+    'audio-16khz-64kbitrate-mono-mp3': (SpeechSynthesisOutputFormat.Audio16Khz64KBitRateMonoMp3, 'mp3'),
+    'audio-24khz-48kbitrate-mono-mp3': (SpeechSynthesisOutputFormat.Audio24Khz48KBitRateMonoMp3, 'mp3'),
+    'audio-24khz-96kbitrate-mono-mp3': (SpeechSynthesisOutputFormat.Audio24Khz96KBitRateMonoMp3, 'mp3'),
+    'ogg-16khz-16bit-mono-opus': (SpeechSynthesisOutputFormat.Ogg16Khz16BitMonoOpus, 'ogg'),
+    'ogg-24khz-16bit-mono-opus': (SpeechSynthesisOutputFormat.Ogg24Khz16BitMonoOpus, 'ogg'),
+    'riff-16khz-16bit-mono-pcm': (SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm, 'wav'),
+    'riff-24khz-16bit-mono-pcm': (SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm, 'wav'),
+}
+
+# Returns the SDK output format (None for the SDK default) and file extension of an audio format
+def get_audio_format(name=None):
+    name = name or AUDIO_FORMAT
+    if name not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format '{name}', expected one of {', '.join(AUDIO_FORMATS)}.")
+    return AUDIO_FORMATS[name]
+
+# Whether audio of a format is PCM in a WAV container, which SSML batches can be split into sentences of
+def audio_format_is_wav(name=None):
+    output_format, _ = get_audio_format(name)
+    return output_format is None or output_format.name.startswith('Riff')
+
+# Generates the SpeechConfig with the given voice
+def get_speech_config(voice):
     speech_config = SpeechConfig(subscription=azure_speech_key, region=azure_service_region)
-    speech_config.speech_synthesis_language = "en-US"
-    speech_config.speech_synthesis_voice_name = random_voice
+    speech_config.speech_synthesis_language = SPEECH_LANGUAGE
+    speech_config.speech_synthesis_voice_name = voice
+    output_format, _ = get_audio_format()
+    if output_format is not None:
+        speech_config.set_speech_synthesis_output_format(output_format)
 
     return speech_config
 
-# Generates an audio for a given text using Azure Speech API and saves the audio file as an MP3
+# Generates the SpeechConfig with a random voice
+def get_speech_config_with_random_voice():
+    return get_speech_config(random.choice(ENGLISH_US_VOICES))
+
+# Picks the voice of a text. Voices vary from sentence to sentence, but a text always gets the same
+# voice, so its audio can be found in the audio cache again.
+def voice_for_text(text):
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return ENGLISH_US_VOICES[int.from_bytes(digest, 'big') % len(ENGLISH_US_VOICES)]
+
+# Key of an audio file in the content-addressed audio cache: a hash of everything that changes the audio
+def audio_cache_key(text, voice, language=SPEECH_LANGUAGE, audio_format=None):
+    audio_format = audio_format or AUDIO_FORMAT
+    return hashlib.blake2b(f'{text}\0{voice}\0{language}\0{audio_format}'.encode('utf-8'), digest_size=16).hexdigest()
+
+# Path of an audio file in the cache. Files are spread over 256 subdirectories so directories stay small
+# with millions of files; the file name, the key plus its extension, is also its Anki media name.
+def audio_cache_path(key, audio_output_dir=AUDIO_OUTPUT_DIR, audio_format=None):
+    _, extension = get_audio_format(audio_format)
+    return f"{audio_output_dir}/{key[:2]}/{key}.{extension}"
+
+# Speech synthesizers of the threads that synthesize audio, keyed on the thread, each with its connection
+# to the speech service and the bookmarks reached during its current synthesis. Every request picks its
+# voice in SSML, so a thread needs a single synthesizer and open connections never outnumber threads.
+speech_synthesizers = {}
+speech_synthesizers_lock = threading.Lock()
+
+# Returns the speech synthesizer of the current thread with its connection and bookmarks. Synthesizers
+# are created once and reused for every sentence, their connection is opened right away instead of on
+# the first request, and they return the audio in the result instead of writing it to a file of their own.
+def get_speech_synthesizer():
+    thread = threading.get_ident()
+    with speech_synthesizers_lock:
+        state = speech_synthesizers.get(thread)
+    if state is None:
+        synthesizer = SpeechSynthesizer(speech_config=get_speech_config(ENGLISH_US_VOICES[0]), audio_config=None)
+        connection = Connection.from_speech_synthesizer(synthesizer)
+        connection.open(True)
+        # Bookmarks reached during the current synthesis, as (name, audio offset in 100 ns ticks)
+        bookmarks = []
+        synthesizer.bookmark_reached.connect(lambda event: bookmarks.append((event.text, event.audio_offset)))
+        state = (synthesizer, connection, bookmarks)
+        with speech_synthesizers_lock:
+            speech_synthesizers[thread] = state
+    return state
+
+# Synthesizes an SSML document with the synthesizer of the current thread, returning the result and its bookmarks
+def speak_ssml(ssml):
+    synthesizer, _, bookmarks = get_speech_synthesizer()
+    bookmarks.clear()
+    result = synthesizer.speak_ssml(ssml)
+    return result, list(bookmarks)
+
+# Closes the speech synthesizer of the current thread, so that the next request sets up a new one
+def discard_speech_synthesizer():
+    with speech_synthesizers_lock:
+        state = speech_synthesizers.pop(threading.get_ident(), None)
+    if state:
+        state[1].close()
+
+# Closes the connections of all speech synthesizers, once the threads using them are done
+def close_speech_synthesizers():
+    with speech_synthesizers_lock:
+        states = list(speech_synthesizers.values())
+        speech_synthesizers.clear()
+    for _, connection, _ in states:
+        connection.close()
+
+# Writes audio data to a file of the audio cache, through a temporary file so an interrupted write
+# never looks like a cached file
+def write_audio_file(audio_file_path, audio_data):
+    os.makedirs(os.path.dirname(audio_file_path), exist_ok=True)
+    temporary_file_path = f"{audio_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_file_path, 'wb') as audio_file:
+        audio_file.write(audio_data)
+    os.replace(temporary_file_path, audio_file_path)
+
+# Generates an audio for a given text using Azure Speech API and saves the audio file as an MP3 in the
+# content-addressed audio cache, returning its key (the media name without extension) and its path
 MAX_RETRIES_TO_GENERATE_AUDIO = 5
 def generate_audio(text, audio_output_dir=AUDIO_OUTPUT_DIR):
-    audio_file_name = slugify(text)
-    audio_file_path = f"{audio_output_dir}/{audio_file_name}.mp3"
+    voice = voice_for_text(text)
+    audio_file_name = audio_cache_key(text, voice)
+    audio_file_path = audio_cache_path(audio_file_name, audio_output_dir)
     logger.info(f"Checking if audio file {audio_file_path} exists.")
 
     for i in range(MAX_RETRIES_TO_GENERATE_AUDIO):
         if not os.path.exists(audio_file_path):
             logger.info(f"File {audio_file_path} does not exist, creating file using Azure Speech API.")
-            audio_config = AudioConfig(filename=audio_file_path)
-            speech_config = get_speech_config_with_random_voice()
-            synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-            result = synthesizer.speak_text(text)
+            rate_limiters['speech'].acquire(len(text))
+            result, _ = speak_ssml(build_ssml([text], voice))
             
             if result.reason == ResultReason.SynthesizingAudioCompleted:
+                write_audio_file(audio_file_path, result.audio_data)
                 logger.info("Audio file created successfully.")
                 break
             elif result.reason == ResultReason.Canceled:
@@ -185,8 +1682,8 @@ def generate_audio(text, audio_output_dir=AUDIO_OUTPUT_DIR):
                 if cancellation_details.error_details:
                     logger.error(f"Error details: {cancellation_details.error_details}")
                 
-                # Remove the file and retry
-                os.remove(audio_file_path)
+                # Retry with a new synthesizer and connection
+                discard_speech_synthesizer()
         else:
             break
     else:
@@ -194,39 +1691,269 @@ def generate_audio(text, audio_output_dir=AUDIO_OUTPUT_DIR):
 
     return [audio_file_name, audio_file_path]
 
-# Reads an input file, generates translated cards with audio,
+# Builds an SSML document that reads texts with a voice. With bookmarks, a bookmark named after the
+# index of each text comes right before it, and an "end" bookmark after the last one.
+def build_ssml(texts, voice, bookmarks=False):
+    if bookmarks:
+        body = ''.join(f'<bookmark mark="{i}"/>{escape(text)} ' for i, text in enumerate(texts)) + '<bookmark mark="end"/>'
+    else:
+        body = ' '.join(escape(text) for text in texts)
+    return (f'<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang={quoteattr(SPEECH_LANGUAGE)}>'
+            f'<voice name={quoteattr(voice)}>{body}</voice></speak>')
+
+# Splits WAV audio data at audio offsets in 100 ns ticks, returning one WAV file per segment
+def split_wav_audio(audio_data, offsets):
+    with wave.open(io.BytesIO(audio_data)) as source:
+        params = source.getparams()
+        frames = source.readframes(source.getnframes())
+    frame_size = params.sampwidth * params.nchannels
+    positions = [min(len(frames), round(offset * params.framerate / 10_000_000) * frame_size) for offset in offsets]
+    segments = []
+    for start, end in zip(positions, positions[1:]):
+        segment = io.BytesIO()
+        with wave.open(segment, 'wb') as target:
+            target.setparams(params)
+            target.writeframes(frames[start:end])
+        segments.append(segment.getvalue())
+    return segments
+
+# Generates the audio of several texts of the same voice with a single SSML request, splitting it at
+# bookmarks into the same cached files generate_audio creates, and returns [audio_file_name,
+# audio_file_path] per text. Texts whose audio is cached are skipped, and if the batch fails or
+# its bookmarks are missing, the remaining texts are synthesized one by one instead.
+def generate_audio_batch(texts, audio_output_dir=AUDIO_OUTPUT_DIR):
+    voice = voice_for_text(texts[0])
+    audio_files = [[audio_cache_key(text, voice)] for text in texts]
+    for audio_file in audio_files:
+        audio_file.append(audio_cache_path(audio_file[0], audio_output_dir))
+    missing = [i for i, (_, audio_file_path) in enumerate(audio_files) if not os.path.exists(audio_file_path)]
+    if len(missing) > 1:
+        logger.info(f"Creating {len(missing)} audio files with a single SSML request to Azure Speech API.")
+        rate_limiters['speech'].acquire(sum(len(texts[i]) for i in missing))
+        result, bookmarks = speak_ssml(build_ssml([texts[i] for i in missing], voice, bookmarks=True))
+        offsets = dict(bookmarks)
+        names = [str(i) for i in range(len(missing))] + ['end']
+        try:
+            if result.reason != ResultReason.SynthesizingAudioCompleted or not all(name in offsets for name in names):
+                raise ValueError(f"SSML batch synthesis did not complete ({result.reason}, {len(bookmarks)} bookmarks)")
+            segments = split_wav_audio(result.audio_data, [offsets[name] for name in names])
+        except (ValueError, wave.Error) as e:
+            logger.warning(f"{e}, creating the audio files one by one.")
+            discard_speech_synthesizer()
+        else:
+            for i, audio_data in zip(missing, segments):
+                write_audio_file(audio_files[i][1], audio_data)
+
+    return [generate_audio(text, audio_output_dir) if not os.path.exists(audio_file_path) else [audio_file_name, audio_file_path]
+            for text, (audio_file_name, audio_file_path) in zip(texts, audio_files)]
+
+# Submits the audio of texts to an executor, each as a future of [audio_file_name, audio_file_path].
+# With a character budget, texts are buffered per voice across card batches and a voice's buffer is
+# sent to generate_audio_batch once the next text would overrun batch_chars, so SSML requests fill up
+# to the budget however the card batches are sized. Buffers older than max_age card batches, and all
+# of them at the end of the input, are sent as they are; a caller that waits for the audio of a text
+# still buffered after SPEECH_BATCH_WAIT seconds sends its buffer itself, so a stalled input never
+# holds back cards. Compressed audio formats cannot be split at bookmarks, so their texts are always
+# synthesized one by one.
+class SpeechBatcher:
+    def __init__(self, executor, batch_chars=SPEECH_BATCH_CHARS, max_age=1):
+        self.executor = executor
+        self.batch_chars = batch_chars if audio_format_is_wav() else 0
+        self.max_age = max_age
+        self.card_batches = 0
+        # Buffered (text, future) entries, their characters and the card batch of the oldest one, per voice
+        self.buffers = {}
+        self.buffered = {}
+        self.condition = threading.Condition()
+
+    def submit(self, text):
+        if not self.batch_chars:
+            return self.executor.submit(generate_audio, text)
+
+        future = Future()
+        voice = voice_for_text(text)
+        with self.condition:
+            if voice in self.buffers and self.buffers[voice][1] + len(text) > self.batch_chars:
+                self.send(voice)
+            entries, chars, card_batch = self.buffers.get(voice, ([], 0, self.card_batches))
+            entries.append((text, future))
+            self.buffers[voice] = (entries, chars + len(text), card_batch)
+            self.buffered[future] = voice
+        return future
+
+    # Marks the start of the next card batch, sending the buffers that have waited for max_age card batches
+    def next_card_batch(self):
+        with self.condition:
+            self.card_batches += 1
+            for voice, (_, _, card_batch) in list(self.buffers.items()):
+                if self.card_batches - card_batch >= self.max_age:
+                    self.send(voice)
+
+    def flush(self):
+        with self.condition:
+            for voice in list(self.buffers):
+                self.send(voice)
+
+    # Waits for the audio of a text, sending its buffer if the batcher does not send it in time
+    def result(self, future):
+        with self.condition:
+            if not self.condition.wait_for(lambda: future not in self.buffered, SPEECH_BATCH_WAIT):
+                self.send(self.buffered[future])
+        return future.result()
+
+    # Sends the buffer of a voice to the executor; called with the condition held
+    def send(self, voice):
+        entries, _, _ = self.buffers.pop(voice)
+        futures = [future for _, future in entries]
+        for future in futures:
+            del self.buffered[future]
+        self.condition.notify_all()
+
+        def resolve(batch_future):
+            for position, future in enumerate(futures):
+                if batch_future.exception():
+                    future.set_exception(batch_future.exception())
+                else:
+                    future.set_result(batch_future.result()[position])
+        self.executor.submit(generate_audio_batch, [text for text, _ in entries]).add_done_callback(resolve)
+
+# Reads the input files, generates translated cards with audio,
 # and creates either an Anki deck or a CSV file based on the specified output format.
-def main(input_file, output_file_name, output_format):
+def main(input_files, output_file_name, output_format, dedup_normalizations=DEDUP_NORMALIZATIONS,
+         field=DEFAULT_SENTENCE_FIELD, input_format=None, line_range=None, shard=None, incremental=True,
+         segment=False, normalize=True, max_length=MAX_SENTENCE_LENGTH, dests=('pt',)):
+    # With several target languages, each one gets its own output named after it
+    if len(dests) > 1 and output_file_name == STDOUT_FILE_NAME:
+        raise ValueError('Only a single target language can be written to stdout.')
+    if output_format != 'csv' and output_file_name == STDOUT_FILE_NAME:
+        raise ValueError('Only CSV output can be written to stdout.')
+    output_file_names = [output_file_name] if len(dests) == 1 else [f'{output_file_name}-{dest}' for dest in dests]
+    side_file_name = STDOUT_SIDE_FILE_NAME if output_file_name == STDOUT_FILE_NAME else output_file_name
+
     # Create necessary directories
     os.makedirs(f"{OUTPUT_DIR}", exist_ok=True)
     os.makedirs(f"{AUDIO_OUTPUT_DIR}", exist_ok=True)
 
-    # Read input file
-    sentences = read_input_file(input_file)
+    # Stream (file_name, sentence) pairs from all input files
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    input_files = expand_input_paths(input_files)
+    sentences = iter_input_files(input_files, field=field, input_format=input_format,
+                                 line_range=line_range, shard=shard)
+
+    # Split paragraphs into sentences, in this process when reading stdin so sentences are not held back
+    if segment:
+        sentences = segment_sentences(sentences, processes=1 if STDIN_FILE_NAME in input_files else None)
 
-    # Generate translated cards
-    cards = create_cards_in_parallel(sentences)
+    # Clean up sentences and set aside the ones that would waste or break translation and TTS
+    if normalize:
+        sentences = normalize_sentences(
+            sentences, reject_file_name=f'{OUTPUT_DIR}/{side_file_name}.rejects.tsv', max_length=max_length,
+            batch_size=1 if STDIN_FILE_NAME in input_files else NORMALIZE_BATCH_SIZE)
 
-    # Write output file
+    # Drop duplicated sentences before they reach translation and TTS
+    if dedup_normalizations is not None:
+        sentences = dedup_sentences(sentences, dedup_normalizations, key=lambda item: item[1])
+
+    # Reuse the cards of earlier runs with the same output and target languages
+    with contextlib.ExitStack() as stack:
+        manifests = None
+        if incremental:
+            manifests = [stack.enter_context(RunManifest(RunManifest.file_name_for(side_file_name, dest))) for dest in dests]
+
+        # Generate translated cards while the input is still being read, one by one when reading stdin
+        if STDIN_FILE_NAME in input_files:
+            card_sets = iter_card_sets_in_parallel(sentences, dests, card_caches=manifests, max_batch_size=1)
+        else:
+            card_sets = iter_card_sets_in_parallel(sentences, dests, card_caches=manifests)
+
+        # Write the output file of every language from the same cards and return the number of cards written
+        writers = [output_writer(name, output_format, deck_id=None if len(dests) == 1 else language_deck_id(dest))
+                   for name, dest in zip(output_file_names, dests)]
+        return sum(fan_out(card_sets, writers))
+
+# Returns a function that writes cards to the output file with the given name and format
+def output_writer(output_file_name, output_format, deck_id=None):
     if output_format == 'anki':
-        create_anki_deck(output_file_name, cards, f"{OUTPUT_DIR}/{output_file_name}.apkg")
+        return lambda cards: create_anki_deck(output_file_name, cards, f"{OUTPUT_DIR}/{output_file_name}.apkg", deck_id=deck_id)
+    elif output_format == 'csv' and output_file_name == STDOUT_FILE_NAME:
+        return lambda cards: write_csv_file(STDOUT_FILE_NAME, cards)
     elif output_format == 'csv':
-        write_csv_file(f'{OUTPUT_DIR}/{output_file_name}.csv', cards)
+        return lambda cards: write_csv_file(f'{OUTPUT_DIR}/{output_file_name}.csv', cards)
+
+# Derives a stable Anki deck ID for each target language, so their decks do not merge when imported
+def language_deck_id(dest):
+    return int.from_bytes(hashlib.blake2b(f'{anki_deck_id}\0{dest}'.encode('utf-8'), digest_size=4).digest(), 'big') >> 1
 
 if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Create Anki decks or CSV files from a CSV input file.')
-    parser.add_argument('--input', help='The input file path')
+    parser.add_argument('--input', nargs='+',
+                        help='The input file paths, glob patterns or directories, or - to read from stdin')
+    parser.add_argument('--input-format', choices=['txt', 'csv', 'jsonl'],
+                        help='The input format, overriding the file extension (default for stdin: txt)')
     parser.add_argument('--format', choices=['anki', 'csv'], default='anki', help='The output format (default: anki)')
-    parser.add_argument('--output', help='The output file name')
+    parser.add_argument('--output', help='The output file name, or - to write CSV rows to stdout')
+    parser.add_argument('--range', type=parse_line_range, metavar='START:END',
+                        help='Only read lines START (inclusive) to END (exclusive) of each TXT input, 0-based')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='Only read the i-th of N equal slices of the lines of each TXT input, 0-based')
+    parser.add_argument('--field', default=DEFAULT_SENTENCE_FIELD,
+                        help='The CSV column, JSONL field or Parquet/Arrow column holding the sentences (default: %(default)s)')
+    parser.add_argument('--segment', action='store_true',
+                        help='Split paragraphs into sentences instead of treating each line or row as one sentence')
+    parser.add_argument('--max-length', type=int, default=MAX_SENTENCE_LENGTH,
+                        help='Reject sentences longer than this many characters (default: %(default)s)')
+    parser.add_argument('--no-normalize', action='store_true',
+                        help='Do not normalize sentences or reject the ones that cannot become cards')
+    parser.add_argument('--dedup', default=','.join(DEDUP_NORMALIZATIONS),
+                        help='Comma-separated normalizations used to detect duplicate sentences (default: %(default)s)')
+    parser.add_argument('--no-dedup', action='store_true', help='Keep duplicate sentences')
+    parser.add_argument('--no-incremental', action='store_true',
+                        help='Create every card again instead of reusing the cards of earlier runs')
+    parser.add_argument('--dest', default='pt',
+                        help='Comma-separated target languages; with several, one output is written per language (default: %(default)s)')
+    parser.add_argument('--import-translations', metavar='TSV',
+                        help='Load the sentence and translation columns of a TSV file into the translation cache and exit')
+    parser.add_argument('--export-translations', metavar='TSV',
+                        help='Write the cached translations into the --dest language to a TSV file, or - for stdout, and exit')
     args = parser.parse_args()
 
-    input_file = args.input
-    output_file_name = os.path.splitext(args.output if args.output else input_file)[0]
+    if args.import_translations or args.export_translations:
+        if not TRANSLATION_CACHE_FILE:
+            parser.error('the translation cache is disabled, set TRANSLATION_CACHE_FILE')
+        if ',' in args.dest:
+            parser.error('translations are imported and exported for a single --dest language')
+        start_time = time.time()
+        with contextlib.closing(TranslationCache(TRANSLATION_CACHE_FILE)) as cache:
+            if args.import_translations:
+                num_rows = cache.import_tsv(args.import_translations, 'en', args.dest)
+                logger.info(f"Imported {num_rows} translations into {TRANSLATION_CACHE_FILE} in {time.time() - start_time:.2f} seconds.")
+            else:
+                num_rows = cache.export_tsv(args.export_translations, 'en', args.dest)
+                logger.info(f"Exported {num_rows} translations from {TRANSLATION_CACHE_FILE} in {time.time() - start_time:.2f} seconds.")
+        sys.exit()
+    if not args.input:
+        parser.error('the following arguments are required: --input')
+
+    input_files = args.input
+    single_input = len(input_files) == 1 and not glob.has_magic(input_files[0]) and input_files[0] != STDIN_FILE_NAME
+    output_file_name = os.path.splitext(args.output if args.output else input_files[0] if single_input else 'deck')[0]
     output_format = args.format
+    dedup_normalizations = None if args.no_dedup else tuple(n.strip() for n in args.dedup.split(',') if n.strip())
+    dests = tuple(dict.fromkeys(dest.strip() for dest in args.dest.split(',') if dest.strip()))
+    if not dests:
+        parser.error('--dest needs at least one target language')
+    if len(dests) > 1 and output_file_name == STDOUT_FILE_NAME:
+        parser.error('only a single --dest language can be written to stdout')
+    if output_format != 'csv' and output_file_name == STDOUT_FILE_NAME:
+        parser.error('--output - writes CSV rows to stdout and needs --format csv')
     start_time = time.time()
-    main(input_file, output_file_name, output_format)
-    num_cards = len(read_input_file(input_file))
+    num_cards = main(input_files, output_file_name, output_format, dedup_normalizations=dedup_normalizations,
+                     field=args.field, input_format=args.input_format, line_range=args.range, shard=args.shard,
+                     incremental=not args.no_incremental, segment=args.segment,
+                     normalize=not args.no_normalize, max_length=args.max_length, dests=dests)
     end_time = time.time()
     time_taken = end_time - start_time
     logger.info(f"Generated {num_cards} cards in {time_taken:.2f} seconds.")
+    logger.info(f"Run summary: {run_stats.summary()}")
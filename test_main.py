@@ -2,11 +2,21 @@ import sys
 import io
 import os
 import csv
+import json
 import unittest
+import bz2
+import gzip
+import lzma
+import mmap
 import tempfile
-from unittest.mock import patch, MagicMock, call
-from azure.cognitiveservices.speech import ResultReason
-from main import read_input_file, write_csv_file, create_anki_deck, create_cards_in_parallel, create_card, get_speech_config_with_random_voice, generate_audio, main, Translator
+import time
+import threading
+import wave
+import genanki
+import main as main_module
+from unittest.mock import patch, MagicMock, call, ANY
+from azure.cognitiveservices.speech import ResultReason, SpeechSynthesisOutputFormat
+from main import read_input_file, iter_input_file, write_csv_file, create_anki_deck, create_cards_in_parallel, iter_cards_in_parallel, iter_card_sets_in_parallel, create_card, dedup_sentences, normalize_for_dedup, expand_input_paths, iter_input_files, detect_compression, zstandard, pyarrow, parse_line_range, parse_shard, RunManifest, split_sentences, segment_sentences, normalize_batch, normalize_sentences, TranslationCache, TranslationEngine, TranslationMemory, OfflineTranslationBackend, GoogleTranslationBackend, create_translation_backend, RunStats, CircuitBreaker, translate, translate_batch, RateLimiter, get_speech_config_with_random_voice, generate_audio, generate_audio_batch, voice_for_text, audio_cache_key, audio_cache_path, get_speech_config, main, Translator
 
 OUTPUT_DIR = 'output'
 AUDIO_OUTPUT_DIR = f'{OUTPUT_DIR}/audio'
@@ -22,6 +32,17 @@ class TestAnkiDeckCreator(unittest.TestCase):
         os.makedirs(self.output_dir, exist_ok=True)
         os.makedirs(self.audio_output_dir, exist_ok=True)
 
+        # Each test starts without a translation backend of the current thread or speech synthesizers
+        self.translator_patch = patch("main.translation_backend_state", threading.local())
+        self.translator_patch.start()
+        self.synthesizer_patch = patch("main.speech_synthesizers", {})
+        self.synthesizer_patch.start()
+        # and without a translation cache or translation engines shared between tests
+        self.translation_cache_file_patch = patch("main.TRANSLATION_CACHE_FILE", None)
+        self.translation_cache_file_patch.start()
+        self.translation_engines_patch = patch("main.translation_engines", {})
+        self.translation_engines_patch.start()
+
         # Suppress print logs
         self.original_stdout = sys.stdout
         sys.stdout = io.StringIO()
@@ -29,6 +50,11 @@ class TestAnkiDeckCreator(unittest.TestCase):
     def tearDown(self):
         # Remove output directory after tests
         self.temp_dir.cleanup()
+        self.translator_patch.stop()
+        self.translation_cache_file_patch.stop()
+        main_module.close_translation_engines()
+        self.translation_engines_patch.stop()
+        self.synthesizer_patch.stop()
         # Restore original stdout
         sys.stdout = self.original_stdout
 
@@ -46,25 +72,243 @@ class TestAnkiDeckCreator(unittest.TestCase):
             sentences = read_input_file(temp_file.name)
             self.assertEqual(sentences, ["Test sentence", "Another test sentence"])
 
+    def test_iter_input_file_is_lazy(self):
+        with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt") as temp_file:
+            temp_file.write("First sentence\r\nSecond sentence\n")
+            temp_file.seek(0)
+            sentences = iter_input_file(temp_file.name)
+            self.assertNotIsInstance(sentences, list)
+            self.assertEqual(next(sentences), "First sentence")
+            self.assertEqual(list(sentences), ["Second sentence"])
+
+    def test_read_input_file_csv_without_sentence_column(self):
+        with tempfile.NamedTemporaryFile(mode="w+", suffix=".csv") as temp_file:
+            temp_file.write("text\nTest sentence\n")
+            temp_file.seek(0)
+            with self.assertRaises(ValueError):
+                read_input_file(temp_file.name)
+
+    def test_read_input_file_compressed(self):
+        content = "sentence\nTest sentence\n\nAnother test sentence\n"
+        for suffix, open_compressed in [(".gz", gzip.open), (".bz2", bz2.open), (".xz", lzma.open)]:
+            file_name = os.path.join(self.temp_dir.name, f"input.csv{suffix}")
+            with open_compressed(file_name, "wt") as f:
+                f.write(content)
+            self.assertEqual(read_input_file(file_name), ["Test sentence", "Another test sentence"])
+
+        # Compression is detected from the magic bytes when the extension does not tell
+        file_name = os.path.join(self.temp_dir.name, "input.txt")
+        with gzip.open(file_name, "wt") as f:
+            f.write("Test sentence\n")
+        self.assertEqual(detect_compression(file_name), "gzip")
+        self.assertEqual(read_input_file(file_name), ["Test sentence"])
+
+    @unittest.skipUnless(zstandard, "zstandard is not installed")
+    def test_read_input_file_zstd(self):
+        file_name = os.path.join(self.temp_dir.name, "input.txt.zst")
+        with open(file_name, "wb") as f:
+            f.write(zstandard.ZstdCompressor().compress(b"Test sentence\n\nAnother test sentence\n"))
+        self.assertEqual(read_input_file(file_name), ["Test sentence", "Another test sentence"])
+
+    def test_read_input_file_jsonl(self):
+        file_name = os.path.join(self.temp_dir.name, "input.jsonl.gz")
+        with gzip.open(file_name, "wt") as f:
+            f.write('{"text": "Test sentence", "id": 1}\n\n{"text": "  "}\n{"id": 3}\n{"text": "Another test sentence"}\n')
+        self.assertEqual(read_input_file(file_name, field="text"), ["Test sentence", "Another test sentence"])
+
+        file_name = os.path.join(self.temp_dir.name, "invalid.jsonl")
+        with open(file_name, "w") as f:
+            f.write('{"text": "Test sentence"}\nnot json\n')
+        with self.assertRaises(ValueError):
+            read_input_file(file_name, field="text")
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_read_input_file_parquet_and_arrow(self):
+        import pyarrow.feather
+        import pyarrow.parquet
+        table = pyarrow.table({
+            "id": [1, 2, 3, 4],
+            "text": ["Test sentence", None, " ", "Another test sentence"],
+        })
+        parquet_file = os.path.join(self.temp_dir.name, "input.parquet")
+        arrow_file = os.path.join(self.temp_dir.name, "input.arrow")
+        pyarrow.parquet.write_table(table, parquet_file)
+        pyarrow.feather.write_feather(table, arrow_file)
+
+        for file_name in [parquet_file, arrow_file]:
+            self.assertEqual(read_input_file(file_name, field="text"), ["Test sentence", "Another test sentence"])
+            with self.assertRaises(ValueError):
+                read_input_file(file_name)
+
+    def test_read_input_file_stdin(self):
+        with patch("sys.stdin", io.StringIO("Test sentence\n\nAnother test sentence\n")):
+            self.assertEqual(read_input_file("-"), ["Test sentence", "Another test sentence"])
+        with patch("sys.stdin", io.StringIO('{"sentence": "Test sentence"}\n')):
+            self.assertEqual(read_input_file("-", input_format="jsonl"), ["Test sentence"])
+        with self.assertRaises(ValueError):
+            read_input_file("-", input_format="parquet")
+
+    def test_iter_input_files_stdin_streams_lines(self):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd) as stdin, os.fdopen(write_fd, "w") as upstream:
+            with patch("sys.stdin", stdin):
+                pairs = iter_input_files(["-"])
+                upstream.write("First sentence\n")
+                upstream.flush()
+                # The first sentence is available before the upstream tool finishes
+                self.assertEqual(next(pairs), ("-", "First sentence"))
+                upstream.write("Second sentence\n")
+                upstream.close()
+                self.assertEqual(list(pairs), [("-", "Second sentence")])
+
+    def test_parse_line_range_and_shard(self):
+        self.assertEqual(parse_line_range("10:20"), (10, 20))
+        self.assertEqual(parse_line_range(":20"), (None, 20))
+        self.assertEqual(parse_shard("1/4"), (1, 4))
+        for value in ["10", "-1:"]:
+            with self.assertRaises(ValueError):
+                parse_line_range(value)
+        for value in ["4/4", "1"]:
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+    def test_read_input_file_txt_range_and_shard(self):
+        file_name = os.path.join(self.temp_dir.name, "input.txt")
+        lines = [f"Sentence {i}" for i in range(10)]
+        lines[3] = ""
+        with open(file_name, "w") as f:
+            f.write("\n".join(lines))
+
+        self.assertEqual(read_input_file(file_name, line_range=(2, 5)), ["Sentence 2", "Sentence 4"])
+        self.assertEqual(read_input_file(file_name, line_range=(8, None)), ["Sentence 8", "Sentence 9"])
+        # The index is cached next to the file
+        self.assertTrue(os.path.exists(file_name + ".idx"))
+
+        # Slices are read with the offsets of their own lines from the cached index
+        with patch("main.build_line_index", side_effect=AssertionError("index rebuilt")):
+            shards = [read_input_file(file_name, shard=(i, 3)) for i in range(3)]
+        self.assertEqual(sum(shards, []), [line for line in lines if line])
+        with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            num_lines, read_offsets = main_module.load_line_index(file_name, mapped_file)
+            self.assertEqual((num_lines, list(read_offsets(2, 4))), (10, [22, 33, 34]))
+        self.assertEqual(read_input_file(file_name, line_range=(0, 4), shard=(1, 2)), ["Sentence 2"])
+
+        # The cached index is rebuilt when the file changes
+        with open(file_name, "a") as f:
+            f.write("\nSentence 10\n")
+        self.assertEqual(read_input_file(file_name, line_range=(9, None)), ["Sentence 9", "Sentence 10"])
+
+        with self.assertRaises(ValueError):
+            read_input_file(file_name, input_format="csv", shard=(0, 2))
+
+    def test_expand_input_paths(self):
+        input_dir = os.path.join(self.temp_dir.name, "input")
+        os.makedirs(os.path.join(input_dir, "part"))
+        for name in ["b.txt", "b.txt.idx", "a.csv", "notes.md", "part/c.txt.gz"]:
+            with open(os.path.join(input_dir, name), "w") as f:
+                f.write("sentence\n")
+
+        self.assertEqual(
+            expand_input_paths([input_dir]),
+            [os.path.join(input_dir, name) for name in ["a.csv", "b.txt", "part/c.txt.gz"]])
+        self.assertEqual(
+            expand_input_paths([os.path.join(input_dir, "**", "*.txt*"), os.path.join(input_dir, "b.txt")]),
+            [os.path.join(input_dir, name) for name in ["b.txt", "part/c.txt.gz"]])
+        # Globs skip files that are not inputs, such as the line index cached next to a TXT file
+        self.assertEqual(
+            expand_input_paths([os.path.join(input_dir, "*")]),
+            [os.path.join(input_dir, name) for name in ["a.csv", "b.txt"]])
+        with self.assertRaises(ValueError):
+            expand_input_paths([os.path.join(input_dir, "*.json")])
+
+    def test_iter_input_files(self):
+        file_names = []
+        for i in range(5):
+            file_name = os.path.join(self.temp_dir.name, f"chapter-{i}.txt")
+            with open(file_name, "w") as f:
+                f.write("\n".join(f"Sentence {i}.{j}" for j in range(2500)))
+            file_names.append(file_name)
+
+        pairs = list(iter_input_files(file_names, max_workers=2))
+        self.assertEqual(pairs, [(file_names[i], f"Sentence {i}.{j}") for i in range(5) for j in range(2500)])
+
+    def test_split_sentences(self):
+        self.assertEqual(
+            split_sentences('Mr. Smith paid $3.50 for it. He said "Thanks!" Then he left... was it late? Yes. J. K. Rowling wrote it, e.g. here.'),
+            ["Mr. Smith paid $3.50 for it.", 'He said "Thanks!"', "Then he left... was it late?", "Yes.", "J. K. Rowling wrote it, e.g. here."])
+        self.assertEqual(split_sentences("It was in the U.S. in 1999. (Really.) No trailing punctuation"),
+                         ["It was in the U.S. in 1999.", "(Really.)", "No trailing punctuation"])
+        self.assertEqual(split_sentences("I said no. Then he left."), ["I said no.", "Then he left."])
+        self.assertEqual(split_sentences("See No. 5 and p. 12 of the report. It is from Mar. 3 in Vol. 2. Go."),
+                         ["See No. 5 and p. 12 of the report.", "It is from Mar. 3 in Vol. 2.", "Go."])
+        self.assertEqual(split_sentences("   "), [])
+
+    def test_segment_sentences(self):
+        paragraphs = [("a.txt", f"First {i}. Second {i}!") for i in range(25)]
+        expected = [("a.txt", f"{word} {i}{mark}") for i in range(25) for word, mark in [("First", "."), ("Second", "!")]]
+        self.assertEqual(list(segment_sentences(iter(paragraphs), processes=1)), expected)
+        self.assertEqual(list(segment_sentences(iter(paragraphs), processes=2, chunk_size=4)), expected)
+
+    def test_normalize_batch(self):
+        self.assertEqual(
+            normalize_batch(["  Cafe\u0301 \t is\u200b  open\x07 ", "", "Line\r\nbreak", "Nul\x00byte"]),
+            ["Caf\u00e9 is open", "", "Line break", "Nulbyte"])
+        self.assertEqual(normalize_batch([]), [])
+
+    def test_normalize_sentences(self):
+        reject_file_name = os.path.join(self.output_dir, "rejects.tsv")
+        sentences = [("a.txt", " Hello\tworld "), ("a.txt", "\u200b"), ("b.txt", "x" * 30), ("b.txt", "Bye")]
+        normalized = normalize_sentences(iter(sentences), reject_file_name=reject_file_name, max_length=20, batch_size=3)
+        self.assertEqual(list(normalized), [("a.txt", "Hello world"), ("b.txt", "Bye")])
+
+        with open(reject_file_name, newline="") as f:
+            rejects = list(csv.DictReader(f, delimiter="\t"))
+        self.assertEqual([(r["source"], r["reason"]) for r in rejects], [("a.txt", "empty"), ("b.txt", "too_long")])
+
+        # A rerun without rejects does not leave the previous run's rejects behind
+        normalized = normalize_sentences(iter([("a.txt", "Bye")]), reject_file_name=reject_file_name)
+        self.assertEqual(list(normalized), [("a.txt", "Bye")])
+        self.assertFalse(os.path.exists(reject_file_name))
+
+    def test_normalize_for_dedup(self):
+        self.assertEqual(normalize_for_dedup("  The  Sky is BLUE!! "), "the sky is blue")
+        self.assertEqual(normalize_for_dedup("The Sky.", normalizations=("case",)), "the sky.")
+
+    def test_dedup_sentences(self):
+        sentences = ["The sky is blue.", "the  sky is blue", "Hello!", "The sky is blue?", "hello"]
+        self.assertEqual(list(dedup_sentences(sentences)), ["The sky is blue.", "Hello!"])
+        self.assertEqual(list(dedup_sentences(sentences, normalizations=("whitespace",))), ["The sky is blue.", "the  sky is blue", "Hello!", "The sky is blue?", "hello"])
+        with self.assertRaises(ValueError):
+            list(dedup_sentences(sentences, normalizations=("accents",)))
+
+        pairs = [("a.txt", "Hello!"), ("b.txt", "hello"), ("b.txt", "Bye")]
+        self.assertEqual(list(dedup_sentences(pairs, key=lambda item: item[1])), [("a.txt", "Hello!"), ("b.txt", "Bye")])
+
     def test_write_csv_file(self):
         cards = [
             {"Front": "Test front", "Back": "Test back", "AudioTag": "[sound:test.mp3]"},
             {"Front": "Another front", "Back": "Another back", "AudioTag": "[sound:another.mp3]"},
         ]
         with tempfile.NamedTemporaryFile(mode="w+", suffix=".csv") as temp_file:
-            write_csv_file(temp_file.name, cards)
+            num_cards = write_csv_file(temp_file.name, iter(cards))
+            self.assertEqual(num_cards, len(cards))
             temp_file.seek(0)
             reader = csv.DictReader(temp_file)
             written_cards = list(reader)
             self.assertEqual(written_cards, cards)
 
+        with patch("sys.stdout", io.StringIO()) as stdout:
+            write_csv_file("-", cards)
+        self.assertEqual(list(csv.DictReader(io.StringIO(stdout.getvalue()))), cards)
+
     def test_create_anki_deck(self):
         cards = [
             {
                 "Front": "Test",
                 "Back": "Teste",
                 "AudioPath": "test",
-                "AudioTag": "[sound:test.mp3]"
+                "AudioTag": "[sound:test.mp3]",
+                "Source": "input/Chapter 01.txt"
             }
         ]
         output_file = os.path.join(self.output_dir, "Test_Deck.apkg")
@@ -75,42 +319,236 @@ class TestAnkiDeckCreator(unittest.TestCase):
             cards[0]["AudioPath"] = temp_audio.name
             cards[0]["AudioTag"] = f"[sound:{os.path.basename(temp_audio.name)}]"
 
-            create_anki_deck("Test Deck", cards, output_file)
+            with patch("main.genanki.Note", wraps=genanki.Note) as mock_note:
+                create_anki_deck("Test Deck", cards, output_file)
             self.assertTrue(os.path.exists(output_file))
+            self.assertEqual(mock_note.call_args.kwargs["tags"], ["chapter-01"])
 
         # Remove the temporary audio file
         os.remove(temp_audio.name)
 
-    @patch("main.cpu_count")
-    @patch("main.Pool")
-    @patch("main.partial")
-    def test_create_cards_in_parallel(self, mock_partial, mock_pool, mock_cpu_count):
-        sentences = ["Test sentence", "Another test sentence"]
+    # Makes the mocked generate_audio create an audio file named after each sentence, returning the
+    # list of sentences it receives
+    def mock_audio_tasks(self, mock_generate_audio):
+        tasks = []
+        lock = threading.Lock()
 
-        # Mock the cpu_count function
-        mock_cpu_count.return_value = 4
+        def generate_audio(sentence):
+            with lock:
+                tasks.append(sentence)
+            audio_file_path = os.path.join(self.audio_output_dir, f"{sentence}.mp3")
+            open(audio_file_path, "w").close()
+            return [sentence, audio_file_path]
 
-        # Mock the card returned by create_card
-        mock_card = {
-            "Front": "Test sentence",
-            "Back": "translated",
-            "AudioPath": "output/audio/test-sentence.mp3",
-            "AudioTag": "[sound:test-sentence.mp3]",
-        }
+        mock_generate_audio.side_effect = generate_audio
+        return tasks
+
+    # Makes the translator uppercase each line of its requests, returning the list of requests it
+    # receives, each as a list of sentences
+    def mock_translation_requests(self, mock_translator):
+        requests = []
+        lock = threading.Lock()
 
-        # Mock the map function of the pool
-        pool_instance = mock_pool.return_value.__enter__.return_value
-        pool_instance.map.return_value = [mock_card] * len(sentences)
+        def translate(text, src, dest):
+            with lock:
+                requests.append(text.split("\n"))
+            return MagicMock(text=text.upper())
+
+        mock_translator.return_value.translate.side_effect = translate
+        return requests
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_create_cards_in_parallel(self, mock_generate_audio, mock_translator):
+        sentences = ["Test sentence", "Another test sentence"]
+
+
+        # Mock the translator and the audio tasks
+        requests = self.mock_translation_requests(mock_translator)
+        tasks = self.mock_audio_tasks(mock_generate_audio)
 
         cards = create_cards_in_parallel(sentences)
 
-        # Check if the functions were called properly
-        mock_cpu_count.assert_called_once()
-        mock_pool.assert_called_once_with(mock_cpu_count.return_value)
-        mock_partial.assert_called_once_with(create_card)
+        # Check if the functions were called properly: one translation request for both sentences
+        self.assertEqual(requests, [sentences])
+        self.assertEqual(sorted(tasks), sorted(sentences))
 
         self.assertEqual(len(cards), len(sentences))
-        self.assertTrue(all([card["Back"] == "translated" for card in cards]))
+        self.assertEqual([card["Back"] for card in cards], ["TEST SENTENCE", "ANOTHER TEST SENTENCE"])
+        self.assertEqual(cards[0]["AudioTag"], "[sound:Test sentence.mp3]")
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_cards_in_parallel_packs_batches(self, mock_generate_audio, mock_translator):
+        requests = self.mock_translation_requests(mock_translator)
+        self.mock_audio_tasks(mock_generate_audio)
+        sentences = [("a.txt", f"Sentence {i}") for i in range(10)]
+
+        cards = list(iter_cards_in_parallel(sentences, max_batch_chars=35, max_batch_size=4))
+
+        # Each sentence takes 12 characters with its separator, so three fit in 35 characters
+        self.assertEqual(sorted(len(request) for request in requests), [1, 3, 3, 3])
+        self.assertEqual([card["Back"] for card in cards], [f"SENTENCE {i}" for i in range(10)])
+        self.assertTrue(all(card["Source"] == "a.txt" for card in cards))
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_card_sets_in_parallel_shares_audio_between_languages(self, mock_generate_audio, mock_translator):
+        requests = self.mock_translation_requests(mock_translator)
+        tasks = self.mock_audio_tasks(mock_generate_audio)
+        sentences = [("a.txt", "Hello"), ("a.txt", "Bye")]
+
+        card_sets = list(iter_card_sets_in_parallel(sentences, ("pt", "es", "fr")))
+
+        # One translation request per language, but a single audio task per sentence
+        dests = [c.kwargs["dest"] for c in mock_translator.return_value.translate.call_args_list]
+        self.assertEqual(sorted(dests), ["es", "fr", "pt"])
+        self.assertEqual(requests, [["Hello", "Bye"]] * 3)
+        self.assertEqual(sorted(tasks), ["Bye", "Hello"])
+        self.assertEqual([[card["Front"] for card in cards] for cards in card_sets], [["Hello"] * 3, ["Bye"] * 3])
+        self.assertEqual(len({card["AudioPath"] for card in card_sets[0]}), 1)
+
+    @patch("main.Translator")
+    @patch("main.generate_audio_batch")
+    def test_iter_cards_in_parallel_batches_speech_by_voice(self, mock_generate_audio_batch, mock_translator):
+        self.mock_translation_requests(mock_translator)
+        requests = []
+        def generate_audio_batch(texts):
+            requests.append(texts)
+            return [[text, f"{self.audio_output_dir}/{text}.mp3"] for text in texts]
+        mock_generate_audio_batch.side_effect = generate_audio_batch
+        sentences = [("a.txt", f"Sentence {i}") for i in range(10)]
+
+        cards = list(iter_cards_in_parallel(sentences, speech_batch_chars=30))
+
+        # Each request reads sentences of one voice and at most 30 characters, and every card gets its own audio
+        for request in requests:
+            self.assertEqual(len({voice_for_text(text) for text in request}), 1)
+            self.assertLessEqual(sum(map(len, request)), 30)
+        self.assertEqual(sorted(text for request in requests for text in request), sorted(s for _, s in sentences))
+        self.assertLess(len(requests), len(sentences))
+        self.assertEqual([card["AudioPath"] for card in cards], [f"{self.audio_output_dir}/Sentence {i}.mp3" for i in range(10)])
+
+    @patch("main.Translator")
+    @patch("main.generate_audio_batch")
+    def test_iter_cards_in_parallel_fills_speech_batches_across_card_batches(self, mock_generate_audio_batch, mock_translator):
+        self.mock_translation_requests(mock_translator)
+        requests = []
+        def generate_audio_batch(texts):
+            requests.append(texts)
+            return [[text, f"{self.audio_output_dir}/{text}.mp3"] for text in texts]
+        mock_generate_audio_batch.side_effect = generate_audio_batch
+        sentences = [("a.txt", f"Sentence {i}") for i in range(100)]
+        voices = {}
+        for _, sentence in sentences:
+            voices.setdefault(voice_for_text(sentence), []).append(sentence)
+
+        # Card batches of 10 sentences hold about one sentence per voice, but a large budget still
+        # reads all sentences of a voice in a single request
+        list(iter_cards_in_parallel(sentences, max_batch_size=10, speech_batch_chars=5000))
+        self.assertEqual(sorted(map(sorted, requests)), sorted(map(sorted, voices.values())))
+
+        # A smaller budget splits the sentences of each voice into as many requests as it needs
+        requests.clear()
+        list(iter_cards_in_parallel(sentences, max_batch_size=10, speech_batch_chars=40))
+        expected = [batch for texts in voices.values() for batch in main_module.iter_packed_batches(texts, 40)]
+        self.assertEqual(sorted(requests), sorted(expected))
+
+    @patch("main.SPEECH_BATCH_WAIT", 0.01)
+    @patch("main.generate_audio_batch", side_effect=lambda texts: [[text, f"{text}.mp3"] for text in texts])
+    def test_speech_batcher_sends_old_and_awaited_buffers(self, mock_generate_audio_batch):
+        with main_module.ThreadPoolExecutor(max_workers=2) as executor:
+            batcher = main_module.SpeechBatcher(executor, batch_chars=1000, max_age=2)
+            batcher.next_card_batch()
+            future = batcher.submit("Hello")
+            batcher.next_card_batch()
+            self.assertFalse(future.done())
+            # Buffers are sent once they have waited for max_age card batches
+            batcher.next_card_batch()
+            self.assertEqual(future.result(timeout=5), ["Hello", "Hello.mp3"])
+
+            # A caller waiting for a buffered text sends its buffer itself
+            self.assertEqual(batcher.result(batcher.submit("Bye")), ["Bye", "Bye.mp3"])
+        self.assertEqual([c.args[0] for c in mock_generate_audio_batch.call_args_list], [["Hello"], ["Bye"]])
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_cards_in_parallel_limits_speech_in_flight(self, mock_generate_audio, mock_translator):
+        self.mock_translation_requests(mock_translator)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+        all_started = threading.Barrier(3, timeout=5)
+
+        def generate_audio(sentence):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            # The first syntheses only finish once three of them are in flight at the same time
+            if sentence in ("s0", "s1", "s2"):
+                all_started.wait()
+            with lock:
+                running[0] -= 1
+            return [sentence, os.path.join(self.audio_output_dir, f"{sentence}.mp3")]
+        mock_generate_audio.side_effect = generate_audio
+
+        cards = list(iter_cards_in_parallel([("a.txt", f"s{i}") for i in range(12)], speech_concurrency=3))
+        self.assertEqual([card["Front"] for card in cards], [f"s{i}" for i in range(12)])
+        self.assertEqual(peak[0], 3)
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_cards_in_parallel_keeps_order_and_streams(self, mock_generate_audio, mock_translator):
+        self.mock_translation_requests(mock_translator)
+        self.mock_audio_tasks(mock_generate_audio)
+        consumed = []
+
+        def sentences():
+            for sentence in ["one", "two", "three", "four"]:
+                consumed.append(sentence)
+                yield "input.txt", sentence
+
+        cards = iter_cards_in_parallel(sentences(), max_in_flight=1, max_batch_size=1, translation_concurrency=1)
+        self.assertEqual(next(cards)["Front"], "one")
+        # Each of the two stages can hold at most one queued batch and one blocked submission
+        self.assertLessEqual(len(consumed), 5)
+        self.assertEqual([card["Front"] for card in cards], ["two", "three", "four"])
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_cards_in_parallel_propagates_input_errors(self, mock_generate_audio, mock_translator):
+
+        def sentences():
+            yield "input.txt", "one"
+            raise ValueError("broken input")
+
+        with self.assertRaises(ValueError):
+            list(iter_cards_in_parallel(sentences()))
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    def test_iter_cards_in_parallel_reuses_manifest_cards(self, mock_generate_audio, mock_translator):
+        requests = self.mock_translation_requests(mock_translator)
+        tasks = self.mock_audio_tasks(mock_generate_audio)
+
+        manifest_file = os.path.join(self.output_dir, "deck.manifest.sqlite3")
+        with RunManifest(manifest_file) as manifest:
+            cards = list(iter_cards_in_parallel([("a.txt", "Hello"), ("a.txt", "Bye")], card_cache=manifest))
+        self.assertEqual((len(requests), len(tasks)), (1, 2))
+
+        # Rerun with an appended sentence: only the new sentence is dispatched
+        requests.clear()
+        tasks.clear()
+        with RunManifest(manifest_file) as manifest:
+            rerun_cards = list(iter_cards_in_parallel([("a.txt", "Hello"), ("a.txt", "Bye"), ("a.txt", "New")], card_cache=manifest))
+            self.assertEqual((manifest.hits, manifest.misses), (2, 1))
+        self.assertEqual(requests, [["New"]])
+        self.assertEqual(tasks, ["New"])
+        self.assertEqual(rerun_cards[:2], cards)
+        self.assertEqual([card["Front"] for card in rerun_cards], ["Hello", "Bye", "New"])
+
+        # Cards with audio of another format are created again
+        with RunManifest(manifest_file) as manifest, patch("main.AUDIO_FORMAT", "ogg-16khz-16bit-mono-opus"):
+            self.assertIsNone(manifest.get("a.txt", "Hello"))
 
     @patch("main.Translator")
     @patch("main.generate_audio")
@@ -141,7 +579,278 @@ class TestAnkiDeckCreator(unittest.TestCase):
         self.assertEqual(result_card, expected_card)
         mock_translator_instance.translate.assert_called_once_with(sentence, src='en', dest='pt')
         mock_generate_audio.assert_called_once_with(sentence)
+        self.assertEqual(create_card(sentence, source="input.txt")["Source"], "input.txt")
     
+    def test_rate_limiter_paces_requests_and_characters(self):
+        # A full bucket lets one second of requests through, then requests leave at the configured rate
+        limiter = RateLimiter(requests_per_second=20)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+        # The character budget is checked too, and large requests wait for their whole debt
+        limiter = RateLimiter(chars_per_second=1000)
+        start = time.monotonic()
+        limiter.acquire(1000)
+        limiter.acquire(300)
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+        # Without rates, nothing waits
+        start = time.monotonic()
+        for _ in range(1000):
+            RateLimiter().acquire(10000)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    @patch("main.Translator")
+    def test_translate_uses_translation_cache(self, mock_translator):
+        mock_translator.return_value.translate.return_value.text = "Olá"
+        stats = RunStats()
+        cache_file = os.path.join(self.output_dir, "translations.sqlite3")
+        with patch("main.TRANSLATION_CACHE_FILE", cache_file), patch("main.run_stats", stats):
+            self.assertEqual(translate("Hello"), "Olá")
+            self.assertEqual(translate("Hello"), "Olá")
+            self.assertEqual(translate("Hello", dest="es"), "Olá")
+
+        # The second call was served from the cache, the other target language was not, and all calls
+        # shared one engine, which checks the backend once and creates one for its request thread
+        self.assertEqual(mock_translator.return_value.translate.call_count, 2)
+        self.assertEqual(mock_translator.call_count, 2)
+        self.assertEqual(stats.as_dict(), {"translation_cache_hits": 1, "translation_cache_misses": 2, "translation_requests": 2, "translation_retries": 0, "translation_breaker_trips": 0, "translation_memory_matches": 0})
+
+        # The cache persists across connections
+        cache = TranslationCache(os.path.join(self.output_dir, "translations.sqlite3"))
+        self.assertEqual(cache.get("Hello", "en", "pt"), "Olá")
+        self.assertIsNone(cache.get("Bye", "en", "pt"))
+        cache.close()
+
+    @patch("main.Translator")
+    def test_translate_batch(self, mock_translator):
+        mock_translate = mock_translator.return_value.translate
+
+        def translate_lines(text, src, dest):
+            return MagicMock(text="\n".join(f"pt:{line}" for line in text.split("\n")))
+        mock_translate.side_effect = translate_lines
+
+        texts = [f"Sentence {i}" for i in range(5)]
+        self.assertEqual(translate_batch(texts, max_chars=30), [f"pt:Sentence {i}" for i in range(5)])
+        # Each sentence takes 11 characters with its separator, so two fit in a 30 character request
+        self.assertEqual(sorted(c.args[0] for c in mock_translate.call_args_list), ["Sentence 0\nSentence 1", "Sentence 2\nSentence 3", "Sentence 4"])
+
+        # When the translation does not keep the line breaks, the sentences are translated one by one
+        mock_translate.reset_mock()
+        mock_translate.side_effect = lambda text, src, dest: MagicMock(text=f"pt:{text.replace(chr(10), ' ')}")
+        self.assertEqual(translate_batch(texts[:2]), ["pt:Sentence 0", "pt:Sentence 1"])
+        self.assertEqual(mock_translate.call_count, 3)
+
+    def test_google_translation_backend_stops_batching_without_line_breaks(self):
+        # A response in the format parsed by the pinned googletrans client, which joins the translated
+        # parts with spaces, so the line breaks between the sentences of a batch are lost
+        requests = []
+        def translate_rpc(translator, text, dest, src):
+            requests.append(text)
+            parts = [[f"{dest}:{line}", None] for line in text.split("\n")]
+            parsed = [[None, None, src], [[[None, None, None, True, None, parts]]], src]
+            return ")]}'\n\n" + json.dumps([["wrb.fr", "MkEWBc", json.dumps(parsed), None, None, None, "generic"]]) + "\n", None
+
+        texts = [f"Sentence {i}" for i in range(4)]
+        with patch("googletrans.client.Translator._translate", translate_rpc), patch("main.run_stats", RunStats()):
+            self.assertEqual(main_module.translate_joined(texts[:2]), ["pt:Sentence 0", "pt:Sentence 1"])
+            self.assertEqual(main_module.translate_joined(texts[2:]), ["pt:Sentence 2", "pt:Sentence 3"])
+
+        # Only the first batch is sent joined; after it came back as one line, sentences go one by one
+        self.assertEqual(requests, ["Sentence 0\nSentence 1", "Sentence 0", "Sentence 1", "Sentence 2", "Sentence 3"])
+
+    def test_translation_cache_import_and_export(self):
+        corpus_file = os.path.join(self.output_dir, "corpus.tsv.gz")
+        with gzip.open(corpus_file, "wt", encoding="utf-8") as file:
+            file.write('Hello  world\tOlá mundo\n"Quoted" text\t"Texto" citado\nno translation\n\tonly translation\n')
+
+        cache = TranslationCache(os.path.join(self.output_dir, "translations.sqlite3"))
+        self.assertEqual(cache.import_tsv(corpus_file, "en", "pt", chunk_size=1), 2)
+        # Imported texts are normalized like input sentences, and quotes are kept as they are
+        self.assertEqual(cache.get("Hello world", "en", "pt"), "Olá mundo")
+        self.assertEqual(cache.get('"Quoted" text', "en", "pt"), '"Texto" citado')
+        self.assertIsNone(cache.get("Hello world", "en", "es"))
+
+        export_file = os.path.join(self.output_dir, "export.tsv")
+        self.assertEqual(cache.export_tsv(export_file, "en", "pt"), 2)
+        self.assertEqual(cache.export_tsv(os.path.join(self.output_dir, "empty.tsv"), "en", "es"), 0)
+        cache.close()
+
+        other_cache = TranslationCache(os.path.join(self.output_dir, "other.sqlite3"))
+        self.assertEqual(other_cache.import_tsv(export_file, "en", "pt"), 2)
+        self.assertEqual(other_cache.get('"Quoted" text', "en", "pt"), '"Texto" citado')
+        other_cache.close()
+
+    @patch("main.TRANSLATION_RETRY_BASE_DELAY", 0.001)
+    @patch("main.translation_breaker")
+    @patch("main.Translator")
+    def test_translate_retries_transient_errors(self, mock_translator, mock_breaker):
+        mock_breaker.wait.return_value = False
+        mock_translator.return_value.translate.side_effect = [ConnectionError("reset"), TimeoutError(), MagicMock(text="Olá")]
+        stats = RunStats()
+        with patch("main.run_stats", stats):
+            self.assertEqual(translate("Hello"), "Olá")
+        self.assertEqual((stats.as_dict()["translation_requests"], stats.as_dict()["translation_retries"]), (3, 2))
+        self.assertEqual([c.args for c in mock_breaker.record.call_args_list], [(False, False), (False, False), (True, False)])
+
+        # The error is raised once the retries are exhausted
+        mock_translator.return_value.translate.side_effect = ConnectionError("down")
+        with patch("main.run_stats", RunStats()), patch("main.TRANSLATION_MAX_RETRIES", 2), self.assertRaises(ConnectionError):
+            translate("Bye")
+        self.assertEqual(mock_translator.return_value.translate.call_count, 6)
+
+    def test_permanent_error_releases_breaker_trial(self):
+        breaker = CircuitBreaker(window=4, error_rate=0.5, cooldown=0.01)
+        backend = MagicMock(transient_errors=(ConnectionError,))
+        backend.translate.side_effect = ValueError("unsupported language")
+        with patch("main.run_stats", RunStats()), patch("main.translation_breaker", breaker), \
+                patch("main.get_translation_backend", return_value=backend):
+            breaker.trip()
+            time.sleep(0.02)
+            # The trial request fails with an error that is not retried, and the breaker opens again
+            with self.assertRaises(ValueError):
+                main_module.send_translation_request(["Hello"], "en", "pt")
+            self.assertFalse(breaker.trial_running)
+            time.sleep(0.02)
+            waiter = threading.Thread(target=breaker.wait)
+            waiter.start()
+            waiter.join(timeout=5)
+            self.assertFalse(waiter.is_alive())
+
+    def test_circuit_breaker_pauses_after_failures(self):
+        stats = RunStats()
+        breaker = CircuitBreaker(window=4, error_rate=0.5, cooldown=0.2)
+        with patch("main.run_stats", stats):
+            for success in (True, False, True):
+                self.assertFalse(breaker.wait())
+                breaker.record(success)
+            # Half of a full window failed: the breaker opens and requests wait for the cooldown
+            breaker.record(False)
+            self.assertEqual(stats.as_dict()["translation_breaker_trips"], 1)
+            start = time.monotonic()
+            self.assertTrue(breaker.wait())
+            self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+            # Other requests wait for the trial request, which opens the breaker again when it fails
+            waiter = threading.Thread(target=breaker.wait)
+            waiter.start()
+            breaker.record(False, trial=True)
+            self.assertEqual(stats.as_dict()["translation_breaker_trips"], 2)
+            waiter.join(timeout=5)
+            self.assertFalse(waiter.is_alive())
+
+            # A successful trial closes it
+            breaker.record(True, trial=True)
+            self.assertFalse(breaker.wait())
+
+    def test_translation_memory_finds_near_duplicates(self):
+        matches_file = os.path.join(self.output_dir, "matches.tsv")
+        memory = TranslationMemory(os.path.join(self.output_dir, "memory.sqlite3"), threshold=0.7, matches_file_name=matches_file)
+        memory.put_many([("The red car is parked in front of the house", "O carro vermelho está estacionado em frente à casa"),
+                         ("Dogs chase cats", "Cães perseguem gatos")], "en", "pt")
+
+        similarity, text, translation = memory.find("The blue car is parked in front of the house", "en", "pt")
+        self.assertEqual((text, translation), ("The red car is parked in front of the house", "O carro vermelho está estacionado em frente à casa"))
+        self.assertGreaterEqual(similarity, 0.7)
+        # Same words in another order, another target language, or nothing alike
+        self.assertIsNone(memory.find("Cats chase dogs", "en", "pt"))
+        self.assertIsNone(memory.find("The blue car is parked in front of the house", "en", "es"))
+        self.assertIsNone(memory.find("Something else entirely", "en", "pt"))
+        memory.close()
+
+        with open(matches_file, newline="", encoding="utf-8") as file:
+            rows = list(csv.DictReader(file, delimiter="\t"))
+        self.assertEqual([row["sentence"] for row in rows], ["The blue car is parked in front of the house"])
+
+    @patch("main.Translator")
+    def test_translation_engine_reuses_translation_memory(self, mock_translator):
+        requests = self.mock_translation_requests(mock_translator)
+        memory_file = os.path.join(self.output_dir, "memory.sqlite3")
+        texts = ["I would like a cup of coffee with milk please", "I would like a cup of tea with milk please"]
+
+        # Flagged matches are listed but still translated
+        with patch("main.run_stats", RunStats()) as stats, patch("main.TRANSLATION_MEMORY", "flag"), \
+                patch("main.TRANSLATION_MEMORY_MATCHES_FILE", os.path.join(self.output_dir, "matches.tsv")):
+            with TranslationEngine(memory_file=memory_file) as engine:
+                engine.submit(texts[:1]).result(timeout=5)
+                self.assertEqual(engine.submit(texts[1:]).result(timeout=5), [texts[1].upper()])
+            self.assertEqual(stats.as_dict()["translation_memory_matches"], 1)
+        self.assertEqual(len(requests), 2)
+
+        # Reused matches take the translation of their near-duplicate without a request
+        requests.clear()
+        with patch("main.run_stats", RunStats()), patch("main.TRANSLATION_MEMORY", "reuse"), \
+                patch("main.TRANSLATION_MEMORY_MATCHES_FILE", os.path.join(self.output_dir, "matches.tsv")):
+            with TranslationEngine(memory_file=memory_file) as engine:
+                translations = engine.submit(["I would like a cup of water with milk please"]).result(timeout=5)
+                self.assertIn(translations, [[texts[0].upper()], [texts[1].upper()]])
+        self.assertEqual(requests, [])
+
+    def test_offline_translation_backend(self):
+        table_file = os.path.join(self.output_dir, "table.tsv")
+        with open(table_file, "w", encoding="utf-8") as file:
+            file.write("Hello\tOlá\nBye\tTchau\n")
+
+        with patch("main.TRANSLATION_BACKEND", "offline"), patch("main.OFFLINE_TRANSLATION_FILE", table_file), patch("main.run_stats", RunStats()):
+            self.assertIsNone(main_module.translation_cache_file())
+            # Texts missing from the table are returned unchanged
+            self.assertEqual(translate_batch(["Hello", "Bye", "Unknown"]), ["Olá", "Tchau", "Unknown"])
+
+        # Every request waits for the configured latency
+        backend = OfflineTranslationBackend(table_file, latency=0.05)
+        start = time.monotonic()
+        self.assertEqual(backend.translate("Hello", "en", "pt"), "Olá")
+        self.assertEqual(backend.translate_batch(["Bye", "Hello"], "en", "pt"), ["Tchau", "Olá"])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_create_translation_backend(self):
+        self.assertIsInstance(create_translation_backend("offline"), OfflineTranslationBackend)
+        with patch("main.Translator"):
+            self.assertIsInstance(create_translation_backend("main:GoogleTranslationBackend"), GoogleTranslationBackend)
+        with self.assertRaises(ValueError):
+            create_translation_backend("unknown")
+
+        # Backends are rejected when they are created, before any request
+        with self.assertRaises(TypeError):
+            create_translation_backend("main:TranslationBackend")
+        with self.assertRaises(TypeError):
+            create_translation_backend("main:Translator")
+        with patch("main.TRANSLATION_BACKEND", "main:TranslationBackend"), self.assertRaises(TypeError):
+            TranslationEngine()
+
+    @patch("main.Translator")
+    def test_translation_engine_runs_requests_concurrently(self, mock_translator):
+        running, peak = [0], [0]
+        lock = threading.Lock()
+        all_started = threading.Barrier(4, timeout=5)
+
+        def translate(text, src, dest):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            # Only returns once four requests are in flight at the same time
+            all_started.wait()
+            with lock:
+                running[0] -= 1
+            return MagicMock(text=text.upper())
+        mock_translator.return_value.translate.side_effect = translate
+
+        cache_file = os.path.join(self.output_dir, "translations.sqlite3")
+        with patch("main.run_stats", RunStats()), TranslationEngine(concurrency=4, max_chars=10, cache_file=cache_file) as engine:
+            futures = [engine.submit([f"Batch {i}"]) for i in range(4)]
+            self.assertEqual([future.result(timeout=5) for future in futures], [[f"BATCH {i}"] for i in range(4)])
+            self.assertEqual(peak[0], 4)
+
+            # Translations are stored in the cache, so a second submission sends no request
+            self.assertEqual(engine.submit(["Batch 0", "Batch 1"]).result(timeout=5), ["BATCH 0", "BATCH 1"])
+        self.assertEqual(mock_translator.return_value.translate.call_count, 4)
+
     @patch("main.SpeechConfig")
     def test_get_speech_config_with_random_voice(self, mock_speech_config):
         speech_config = get_speech_config_with_random_voice()
@@ -149,18 +858,20 @@ class TestAnkiDeckCreator(unittest.TestCase):
         self.assertEqual(speech_config.speech_synthesis_language, "en-US")
         self.assertTrue(speech_config.speech_synthesis_voice_name.startswith("en-US-"))
     
-    @patch("main.get_speech_config_with_random_voice")
+    @patch("main.Connection")
+    @patch("main.get_speech_config")
     @patch("main.SpeechSynthesizer")
-    @patch("main.AudioConfig")
-    def test_generate_audio(self, mock_audio_config, mock_speech_synthesizer, mock_get_speech_config):
+    def test_generate_audio(self, mock_speech_synthesizer, mock_get_speech_config, mock_connection):
         # Arrange
         text = "Hello, World!"
-        audio_file_name = "hello-world"
-        audio_file_path = f"{self.audio_output_dir}/{audio_file_name}.mp3"
+        voice = voice_for_text(text)
+        audio_file_name = audio_cache_key(text, voice)
+        audio_file_path = f"{self.audio_output_dir}/{audio_file_name[:2]}/{audio_file_name}.mp3"
 
         # Mock result object
         mock_result = MagicMock()
         mock_result.reason = ResultReason.SynthesizingAudioCompleted
+        mock_result.audio_data = b"audio"
 
         # Mock speech config
         mock_speech_config = MagicMock()
@@ -168,7 +879,7 @@ class TestAnkiDeckCreator(unittest.TestCase):
 
         # Mock synthesizer object
         mock_synthesizer_instance = MagicMock()
-        mock_synthesizer_instance.speak_text.return_value = mock_result
+        mock_synthesizer_instance.speak_ssml.return_value = mock_result
         mock_speech_synthesizer.return_value = mock_synthesizer_instance
 
         # Act
@@ -177,15 +888,133 @@ class TestAnkiDeckCreator(unittest.TestCase):
         # Assert
         self.assertEqual(result_file_name, audio_file_name)
         self.assertEqual(result_file_path, audio_file_path)
-        mock_audio_config.assert_called_once_with(filename=audio_file_path)
-        mock_speech_synthesizer.assert_called_once_with(speech_config=mock_speech_config, audio_config=mock_audio_config.return_value)
-        mock_synthesizer_instance.speak_text.assert_called_once_with(text)
-    
-    @patch("main.read_input_file")
-    @patch("main.create_cards_in_parallel")
+        with open(audio_file_path, "rb") as audio_file:
+            self.assertEqual(audio_file.read(), b"audio")
+        self.assertEqual(os.listdir(os.path.dirname(audio_file_path)), [f"{audio_file_name}.mp3"])
+        mock_speech_synthesizer.assert_called_once_with(speech_config=mock_speech_config, audio_config=None)
+        mock_connection.from_speech_synthesizer.return_value.open.assert_called_once_with(True)
+        # The voice is picked in the SSML of the request
+        self.assertIn(f'<voice name="{voice}">{text}</voice>', mock_synthesizer_instance.speak_ssml.call_args.args[0])
+
+        # The cached file is found again without synthesizing it
+        self.assertEqual(generate_audio(text, audio_output_dir=self.audio_output_dir), [audio_file_name, audio_file_path])
+        mock_synthesizer_instance.speak_ssml.assert_called_once()
+
+        # Texts of other voices reuse the synthesizer and its connection of the thread
+        other_text = next(f"Sentence {i}" for i in range(100) if voice_for_text(f"Sentence {i}") != voice)
+        generate_audio(other_text, audio_output_dir=self.audio_output_dir)
+        self.assertEqual(mock_synthesizer_instance.speak_ssml.call_count, 2)
+        self.assertIn(f'<voice name="{voice_for_text(other_text)}">', mock_synthesizer_instance.speak_ssml.call_args.args[0])
+        mock_speech_synthesizer.assert_called_once()
+
+    @patch("main.Connection")
+    @patch("main.get_speech_config")
+    @patch("main.SpeechSynthesizer")
+    def test_generate_audio_batch(self, mock_speech_synthesizer, mock_get_speech_config, mock_connection):
+        voice = voice_for_text("Sentence 0")
+        texts = [f"Sentence {i}" for i in range(100) if voice_for_text(f"Sentence {i}") == voice][:2]
+        mock_synthesizer_instance = mock_speech_synthesizer.return_value
+
+        # One second of 16 kHz mono audio, with the second sentence starting at 0.25 s and the end at 0.5 s
+        def speak_ssml(ssml):
+            bookmark_reached = mock_synthesizer_instance.bookmark_reached.connect.call_args.args[0]
+            for mark, offset in [("0", 0), ("1", 2_500_000), ("end", 5_000_000)]:
+                bookmark_reached(MagicMock(text=mark, audio_offset=offset))
+            audio_data = io.BytesIO()
+            with wave.open(audio_data, "wb") as audio:
+                audio.setparams((1, 2, 16000, 0, "NONE", "not compressed"))
+                audio.writeframes(b"\0\0" * 16000)
+            return MagicMock(reason=ResultReason.SynthesizingAudioCompleted, audio_data=audio_data.getvalue())
+        mock_synthesizer_instance.speak_ssml.side_effect = speak_ssml
+
+        audio_files = generate_audio_batch(texts, audio_output_dir=self.audio_output_dir)
+
+        # A single SSML request, split at the bookmarks into the cached file of each sentence
+        ssml = mock_synthesizer_instance.speak_ssml.call_args.args[0]
+        self.assertIn(f'<voice name="{voice}"><bookmark mark="0"/>{texts[0]} <bookmark mark="1"/>{texts[1]}', ssml)
+        mock_synthesizer_instance.speak_ssml.assert_called_once()
+        for text, (audio_file_name, audio_file_path) in zip(texts, audio_files):
+            self.assertEqual(audio_file_name, audio_cache_key(text, voice))
+            with wave.open(audio_file_path) as audio:
+                self.assertEqual(audio.getnframes(), 4000)
+
+        # Cached sentences are not synthesized again, and a failed batch falls back to one request per sentence
+        def speak_ssml_failing_batches(ssml):
+            if "<bookmark" in ssml:
+                return MagicMock(reason=ResultReason.Canceled)
+            return MagicMock(reason=ResultReason.SynthesizingAudioCompleted, audio_data=b"audio")
+        mock_synthesizer_instance.speak_ssml.side_effect = speak_ssml_failing_batches
+        others = [f"Other {i}" for i in range(100) if voice_for_text(f"Other {i}") == voice][:2]
+        self.assertEqual(generate_audio_batch(texts + others, audio_output_dir=self.audio_output_dir)[:2], audio_files)
+        requests = [c.args[0] for c in mock_synthesizer_instance.speak_ssml.call_args_list[1:]]
+        self.assertEqual(len(requests), 3)
+        self.assertNotIn(texts[0], requests[0])
+        self.assertEqual([f'<voice name="{voice}">{text}</voice>' in request for request, text in zip(requests[1:], others)], [True, True])
+
+    @patch("main.Connection")
+    @patch("main.get_speech_config")
+    @patch("main.SpeechSynthesizer")
+    def test_speech_synthesizer_connections_are_closed(self, mock_speech_synthesizer, mock_get_speech_config, mock_connection):
+        connections = [MagicMock(), MagicMock(), MagicMock()]
+        mock_connection.from_speech_synthesizer.side_effect = connections
+        canceled = MagicMock(reason=ResultReason.Canceled)
+        completed = MagicMock(reason=ResultReason.SynthesizingAudioCompleted, audio_data=b"audio")
+        mock_speech_synthesizer.return_value.speak_ssml.side_effect = [canceled, completed, completed]
+
+        # A canceled synthesis closes the connection of its synthesizer before retrying with a new one
+        with patch("main.SpeechSynthesisCancellationDetails"):
+            generate_audio("Hello", audio_output_dir=self.audio_output_dir)
+        connections[0].close.assert_called_once()
+        connections[1].close.assert_not_called()
+
+        # Another thread gets its own synthesizer, and all of them are closed at the end
+        thread = threading.Thread(target=generate_audio, args=("Bye", self.audio_output_dir))
+        thread.start()
+        thread.join()
+        main_module.close_speech_synthesizers()
+        connections[1].close.assert_called_once()
+        connections[2].close.assert_called_once()
+        self.assertEqual(main_module.speech_synthesizers, {})
+
+    @patch("main.SpeechConfig")
+    def test_get_speech_config_sets_audio_format(self, mock_speech_config):
+        # The SDK default format is left alone, and other formats are requested from the speech service
+        get_speech_config("en-US-AriaNeural")
+        mock_speech_config.return_value.set_speech_synthesis_output_format.assert_not_called()
+        with patch("main.AUDIO_FORMAT", "audio-24khz-48kbitrate-mono-mp3"):
+            get_speech_config("en-US-AriaNeural")
+        mock_speech_config.return_value.set_speech_synthesis_output_format.assert_called_once_with(
+            SpeechSynthesisOutputFormat.Audio24Khz48KBitRateMonoMp3)
+
+    def test_audio_cache_key(self):
+        # Sentences that slugify the same way get their own audio
+        self.assertNotEqual(audio_cache_key("It's fine.", "en-US-AriaNeural"), audio_cache_key("Its fine", "en-US-AriaNeural"))
+        # The voice, language and format are part of the key
+        key = audio_cache_key("Hello", "en-US-AriaNeural")
+        self.assertNotEqual(key, audio_cache_key("Hello", "en-US-GuyNeural"))
+        self.assertNotEqual(key, audio_cache_key("Hello", "en-US-AriaNeural", language="en-GB"))
+        self.assertNotEqual(key, audio_cache_key("Hello", "en-US-AriaNeural", audio_format="ogg"))
+        # The audio format defaults to AUDIO_FORMAT, and its extension names the cached file
+        with patch("main.AUDIO_FORMAT", "ogg-16khz-16bit-mono-opus"):
+            self.assertEqual(audio_cache_key("Hello", "en-US-AriaNeural"), audio_cache_key("Hello", "en-US-AriaNeural", audio_format="ogg-16khz-16bit-mono-opus"))
+            self.assertEqual(audio_cache_path(key, "audio"), f"audio/{key[:2]}/{key}.ogg")
+        self.assertEqual(audio_cache_path(key, "audio"), f"audio/{key[:2]}/{key}.mp3")
+        self.assertEqual(audio_cache_path(key, "audio", "riff-24khz-16bit-mono-pcm"), f"audio/{key[:2]}/{key}.wav")
+        with self.assertRaises(ValueError):
+            audio_cache_path(key, "audio", "flac")
+        # Long sentences still get short file names, and a text always gets the same voice
+        self.assertEqual(len(audio_cache_key("word " * 1000, "en-US-AriaNeural")), 32)
+        self.assertEqual(voice_for_text("Hello"), voice_for_text("Hello"))
+
+    @patch("main.normalize_sentences")
+    @patch("main.RunManifest")
+    @patch("main.expand_input_paths")
+    @patch("main.dedup_sentences")
+    @patch("main.iter_input_files")
+    @patch("main.iter_card_sets_in_parallel")
     @patch("main.create_anki_deck")
     @patch("main.write_csv_file")
-    def test_main(self, mock_write_csv_file, mock_create_anki_deck, mock_create_cards_in_parallel, mock_read_input_file):
+    def test_main(self, mock_write_csv_file, mock_create_anki_deck, mock_iter_card_sets_in_parallel, mock_iter_input_files, mock_dedup_sentences, mock_expand_input_paths, mock_run_manifest, mock_normalize_sentences):
         input_file = "input.csv"
         output_file_name = "output"
         output_format = "anki"
@@ -194,18 +1023,94 @@ class TestAnkiDeckCreator(unittest.TestCase):
         sentences = ["Hello, World!", "How are you?"]
         cards = [{"Front": "Hello, World!", "Back": "Olá, Mundo!"}, {"Front": "How are you?", "Back": "Como você está?"}]
         
-        mock_read_input_file.return_value = sentences
-        mock_create_cards_in_parallel.return_value = cards
+        mock_expand_input_paths.return_value = [input_file]
+        mock_iter_input_files.return_value = sentences
+        mock_normalize_sentences.return_value = sentences
+        mock_dedup_sentences.return_value = sentences
+        mock_iter_card_sets_in_parallel.return_value = [[card] for card in cards]
+        mock_create_anki_deck.side_effect = lambda name, cards, output_file, deck_id: len(list(cards))
 
         # Call main
-        main(input_file, output_file_name, output_format)
+        num_cards = main(input_file, output_file_name, output_format)
 
         # Check if called functions are correct
-        mock_read_input_file.assert_called_once_with(input_file)
-        mock_create_cards_in_parallel.assert_called_once_with(sentences)
-        mock_create_anki_deck.assert_called_once_with(output_file_name, cards, f"{OUTPUT_DIR}/{output_file_name}.apkg")
+        self.assertEqual(num_cards, len(cards))
+        mock_expand_input_paths.assert_called_once_with([input_file])
+        mock_iter_input_files.assert_called_once_with([input_file], field="sentence", input_format=None, line_range=None, shard=None)
+        mock_normalize_sentences.assert_called_once_with(
+            sentences, reject_file_name=f"{OUTPUT_DIR}/{output_file_name}.rejects.tsv", max_length=500, batch_size=10000)
+        mock_dedup_sentences.assert_called_once_with(sentences, ("case", "whitespace", "punctuation"), key=ANY)
+        mock_run_manifest.file_name_for.assert_called_once_with(output_file_name, "pt")
+        mock_iter_card_sets_in_parallel.assert_called_once_with(sentences, ("pt",), card_caches=[mock_run_manifest.return_value.__enter__.return_value])
+        mock_create_anki_deck.assert_called_once_with(output_file_name, ANY, f"{OUTPUT_DIR}/{output_file_name}.apkg", deck_id=None)
         mock_write_csv_file.assert_not_called()
 
+    @patch("main.normalize_sentences", side_effect=lambda sentences, **kwargs: sentences)
+    @patch("main.RunManifest")
+    @patch("main.iter_input_files", return_value=[("-", "Hello")])
+    @patch("main.iter_card_sets_in_parallel", return_value=[[{"Front": "Hello", "Back": "Olá"}]])
+    @patch("main.write_csv_file", side_effect=lambda file_name, cards: len(list(cards)))
+    def test_main_names_side_files_of_stdout_output(self, mock_write_csv_file, mock_iter_card_sets_in_parallel, mock_iter_input_files, mock_run_manifest, mock_normalize_sentences):
+        with patch("main.OUTPUT_DIR", self.output_dir), patch("main.AUDIO_OUTPUT_DIR", self.audio_output_dir):
+            self.assertEqual(main("-", "-", "csv"), 1)
+
+        # Cards go to stdout, but the rejects file and the manifest get a real name
+        mock_write_csv_file.assert_called_once_with("-", ANY)
+        self.assertEqual(mock_normalize_sentences.call_args.kwargs["reject_file_name"], f"{self.output_dir}/stdout.rejects.tsv")
+        mock_run_manifest.file_name_for.assert_called_once_with("stdout", "pt")
+
+        # Anki decks cannot be written to stdout
+        with self.assertRaises(ValueError):
+            main("-", "-", "anki")
+
+    @patch("main.Translator")
+    @patch("main.generate_audio")
+    @patch("main.write_csv_file")
+    @patch("main.iter_input_files")
+    def test_main_does_not_reuse_cards_of_another_language(self, mock_iter_input_files, mock_write_csv_file, mock_generate_audio, mock_translator):
+        self.mock_audio_tasks(mock_generate_audio)
+        mock_translator.return_value.translate.side_effect = lambda text, src, dest: MagicMock(text=f"{dest}:{text}")
+        mock_iter_input_files.side_effect = lambda *args, **kwargs: iter([("input.txt", "Hello")])
+        backs = []
+        def write_csv_file(file_name, cards):
+            backs.append([card["Back"] for card in cards])
+            return len(backs[-1])
+        mock_write_csv_file.side_effect = write_csv_file
+
+        # Reruns into another language get their own manifest instead of the cards of the first run
+        with patch("main.OUTPUT_DIR", self.output_dir), patch("main.AUDIO_OUTPUT_DIR", self.audio_output_dir):
+            main("input.txt", "deck", "csv", dests=("pt",))
+            main("input.txt", "deck", "csv", dests=("es",))
+        self.assertEqual(backs, [["pt:Hello"], ["es:Hello"]])
+
+        # Adding an input file keeps the manifest, and only the new file's sentences are translated
+        mock_iter_input_files.side_effect = lambda *args, **kwargs: iter([("input.txt", "Hello"), ("more.txt", "Bye")])
+        mock_translator.return_value.translate.reset_mock()
+        with patch("main.OUTPUT_DIR", self.output_dir), patch("main.AUDIO_OUTPUT_DIR", self.audio_output_dir):
+            main(["input.txt", "more.txt"], "deck", "csv", dests=("pt",))
+        self.assertEqual(backs[-1], ["pt:Hello", "pt:Bye"])
+        self.assertEqual([c.args[0] for c in mock_translator.return_value.translate.call_args_list], ["Bye"])
+
+    @patch("main.normalize_sentences", side_effect=lambda sentences, **kwargs: sentences)
+    @patch("main.iter_input_files")
+    @patch("main.iter_card_sets_in_parallel")
+    def test_main_writes_one_output_per_language(self, mock_iter_card_sets_in_parallel, mock_iter_input_files, mock_normalize_sentences):
+        mock_iter_input_files.return_value = [("input.txt", "Hello"), ("input.txt", "Bye")]
+        mock_iter_card_sets_in_parallel.return_value = [
+            [{"Front": sentence, "Back": f"{dest}:{sentence}"} for dest in ("pt", "es", "fr")] for sentence in ("Hello", "Bye")]
+
+        with patch("main.OUTPUT_DIR", self.output_dir), patch("main.AUDIO_OUTPUT_DIR", self.audio_output_dir):
+            num_cards = main("input.txt", "deck", "csv", incremental=False, dests=("pt", "es", "fr"))
+
+        self.assertEqual(num_cards, 6)
+        self.assertEqual(mock_iter_card_sets_in_parallel.call_args.args[1], ("pt", "es", "fr"))
+        for dest in ("pt", "es", "fr"):
+            with open(os.path.join(self.output_dir, f"deck-{dest}.csv"), newline="") as file:
+                self.assertEqual([row["Back"] for row in csv.DictReader(file)], [f"{dest}:Hello", f"{dest}:Bye"])
+
+        with self.assertRaises(ValueError):
+            main("input.txt", "-", "csv", dests=("pt", "es"))
+
 
 
 if __name__ == "__main__":